@@ -1,12 +1,24 @@
 import json
+import asyncio
+import hashlib
+import shutil
+import sqlite3
+import ijson
 from pathlib import Path
-from llama_index.core import Document, VectorStoreIndex, StorageContext, Settings
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.core import Document, Settings
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.schema import BaseNode, MetadataMode, NodeRelationship, TextNode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from dotenv import load_dotenv
+from fastembed import SparseTextEmbedding
+from pydantic import PrivateAttr
+from qdrant_client import AsyncQdrantClient, models
 import os
-from typing import List, Dict
+import numpy as np
+import torch
+from typing import Any, Iterable, Iterator, List, Dict, Sequence, Tuple
 
 # Auto-resolve paths from script location
 SCRIPT_DIR = Path(__file__).parent.resolve()
@@ -15,45 +27,422 @@ HF_CACHE_DIR = SCRIPT_DIR / "hf_cache"
 ENV_FILE = SCRIPT_DIR / ".env"
 DENSE_MODEL_NAME = "AITeamVN/Vietnamese_Embedding" 
 SPARSE_MODEL_NAME = "Qdrant/bm25"
+SPARSE_BATCH_SIZE = 64
+SPARSE_PARALLEL_MIN = 4096  # Ít text hơn thì chạy 1 process (spawn pool đắt hơn phần tính)
+EMBED_BATCH_SIZE = 64
 
-# ===== CHUNK SETTINGS =====
-CHUNK_SIZE =  10000
-CHUNK_OVERLAP = 0  
+# ===== ONNX RUNTIME (CPU only) =====
+USE_ONNX_ON_CPU = True
+ONNX_MODEL_DIR = HF_CACHE_DIR / "onnx"
+SBERT_CONFIG_FILE = "sentence_bert_config.json"
+
+# ===== EMBEDDING CACHE =====
+EMBED_CACHE_PATH = HF_CACHE_DIR / "emb_cache.sqlite"
+
+# ===== TORCH.COMPILE (GPU only) =====
+USE_TORCH_COMPILE = True
+# Inductor cache trên disk → các lần chạy sau không phải compile lại kernel
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(HF_CACHE_DIR / "inductor"))
+
+# ===== METADATA SETTINGS =====
+EXCLUDED_LLM_METADATA_KEYS = ['doc_number', 'short_name', 'references', 'status', 'effective_date', 'article_key']
+# Không ghép metadata vào input embedding (chỉ embed page_content) → sequence ngắn hơn.
+# Lọc theo doc_type/short_name/... dùng payload filter của Qdrant.
+EXCLUDED_EMBED_METADATA_KEYS = [
+    'doc_type', 'doc_number', 'doc_name', 'short_name', 'chapter',
+    'article_id', 'article_title', 'effective_date', 'status', 'references', 'article_key',
+]
+EMPTY_REFERENCES = "[]"
+
+# ===== QDRANT UPLOAD SETTINGS =====
+# Tên vector giống mặc định của QdrantVectorStore (enable_hybrid=True)
+DENSE_VECTOR_NAME = "text-dense"
+SPARSE_VECTOR_NAME = "text-sparse-new"
+QDRANT_GRPC_PORT = 6334
+UPLOAD_BATCH_SIZE = 256
+PIPELINE_BATCH_SIZE = 512
+PIPELINE_QUEUE_SIZE = 4
 
 # ===== NEW COLLECTION NAME00000 =====
 NEW_COLLECTION_NAME = "legal_decrees_LBV"
 
 
-def load_data(json_path: str) -> List[Dict]:
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data_list = json.load(f)
-    print(f"Loaded: {len(data_list)} documents")
-    return data_list
+def load_data(json_path: str) -> Iterator[Dict]:
+    """Stream từng record trong file JSON (không load cả file vào RAM)"""
+    with open(json_path, 'rb') as f:
+        yield from ijson.items(f, 'item')
 
 
-def create_documents(data_list: List[Dict]) -> List[Document]:
-    documents = []
-    for item in data_list:
-        metadata = item.get('metadata', {})
-        doc = Document(
+def create_documents(data_list: Iterable[Dict]) -> List[Document]:
+    _Doc = Document
+    _dumps = json.dumps
+    return [
+        _Doc(
             text=item.get('page_content', ''),
             metadata={
-                "doc_type": metadata.get('doc_type', ''),
-                "doc_number": metadata.get('doc_number', ''),
-                "doc_name": metadata.get('doc_name', ''),
-                "short_name": metadata.get('short_name', ''),
-                "chapter": metadata.get('chapter', ''),
-                "article_id": metadata.get('article_id', ''),
-                "article_title": metadata.get('article_title', ''),
-                "effective_date": metadata.get('effective_date', ''),
-                "status": metadata.get('status', ''),
-                "references": json.dumps(metadata.get('references', []), ensure_ascii=False),
+                "doc_type": (meta := item.get('metadata', {})).get('doc_type', ''),
+                "doc_number": meta.get('doc_number', ''),
+                "doc_name": meta.get('doc_name', ''),
+                "short_name": meta.get('short_name', ''),
+                "chapter": meta.get('chapter', ''),
+                "article_id": meta.get('article_id', ''),
+                "article_title": meta.get('article_title', ''),
+                "effective_date": meta.get('effective_date', ''),
+                "status": meta.get('status', ''),
+                "references": _dumps(refs, ensure_ascii=False) if (refs := meta.get('references')) else EMPTY_REFERENCES,
+                # Key dedup theo điều luật, tính 1 lần lúc ingest (backend dùng thẳng, không ghép lại mỗi request)
+                "article_key": f"{meta.get('doc_number', '')}|{meta.get('article_id', '')}|{meta.get('chapter', '')}",
             },
-            excluded_llm_metadata_keys=['doc_number', 'short_name', 'references', 'status', 'effective_date'], 
-            excluded_embed_metadata_keys=['doc_number', 'short_name', 'article_id', 'references', 'effective_date', 'status'] 
+            excluded_llm_metadata_keys=EXCLUDED_LLM_METADATA_KEYS,
+            excluded_embed_metadata_keys=EXCLUDED_EMBED_METADATA_KEYS,
         )
-        documents.append(doc)
-    return documents
+        for item in data_list
+    ]
+
+
+class IdentityNodeParser(NodeParser):
+    """Mỗi Document (1 điều luật) → đúng 1 TextNode, không tách câu"""
+    
+    def _parse_nodes(
+        self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any
+    ) -> List[BaseNode]:
+        return [
+            TextNode(
+                text=doc.get_content(),
+                metadata=doc.metadata,
+                excluded_embed_metadata_keys=doc.excluded_embed_metadata_keys,
+                excluded_llm_metadata_keys=doc.excluded_llm_metadata_keys,
+                relationships={NodeRelationship.SOURCE: doc.as_related_node_info()},
+            )
+            for doc in nodes
+        ]
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """Dense embedding chạy bằng ONNX Runtime (nhanh hơn PyTorch trên CPU).
+    
+    Dùng CLS pooling + L2 normalize giống cấu hình sentence-transformers của
+    Vietnamese_Embedding để vector khớp với phía query (HuggingFaceEmbedding).
+    """
+    _model: Any = PrivateAttr()
+    _tokenizer: Any = PrivateAttr()
+    _max_length: int = PrivateAttr()
+    
+    def __init__(self, model_dir: Path, **kwargs: Any):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        super().__init__(model_name=DENSE_MODEL_NAME, **kwargs)
+        self._model = ORTModelForFeatureExtraction.from_pretrained(
+            str(model_dir), file_name="model_optimized.onnx", provider="CPUExecutionProvider"
+        )
+        self._tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        # Cắt theo max_seq_length của sentence-transformers (như phía query/PyTorch),
+        # không theo model_max_length của tokenizer (8192) → văn bản dài ra cùng vector
+        self._max_length = load_max_seq_length(model_dir)
+    
+    @property
+    def max_length(self) -> int:
+        return self._max_length
+    
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+    
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        # Padding theo câu dài nhất trong batch
+        inputs = self._tokenizer(
+            texts, padding=True, truncation=True, max_length=self._max_length, return_tensors="np"
+        )
+        outputs = self._model(**inputs)
+        hidden = np.asarray(outputs.last_hidden_state)
+        cls = hidden[:, 0]
+        cls = cls / np.linalg.norm(cls, axis=1, keepdims=True)
+        return cls.tolist()
+    
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._encode([query])[0]
+    
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+    
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+    
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+
+def load_max_seq_length(model_dir: Path) -> int:
+    """max_seq_length trong sentence_bert_config.json (tải từ Hub nếu bản export cũ chưa có)"""
+    config_path = model_dir / SBERT_CONFIG_FILE
+    if not config_path.exists():
+        from huggingface_hub import hf_hub_download
+        
+        downloaded = hf_hub_download(DENSE_MODEL_NAME, SBERT_CONFIG_FILE, cache_dir=str(HF_CACHE_DIR))
+        shutil.copyfile(downloaded, config_path)
+    with open(config_path, encoding="utf-8") as f:
+        return int(json.load(f)["max_seq_length"])
+
+
+def export_onnx_model(model_dir: Path = ONNX_MODEL_DIR) -> Path:
+    """Export Vietnamese_Embedding sang ONNX (O3 graph optimization), chỉ chạy lần đầu"""
+    if (model_dir / "model_optimized.onnx").exists():
+        return model_dir
+    
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer
+    from optimum.onnxruntime.configuration import AutoOptimizationConfig
+    from transformers import AutoTokenizer
+    
+    print(f"📦 Exporting {DENSE_MODEL_NAME} to ONNX: {model_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        DENSE_MODEL_NAME, export=True, cache_dir=str(HF_CACHE_DIR)
+    )
+    tokenizer = AutoTokenizer.from_pretrained(DENSE_MODEL_NAME, cache_dir=str(HF_CACHE_DIR))
+    
+    optimizer = ORTOptimizer.from_pretrained(model)
+    optimizer.optimize(save_dir=str(model_dir), optimization_config=AutoOptimizationConfig.O3())
+    tokenizer.save_pretrained(str(model_dir))
+    load_max_seq_length(model_dir)  # Lưu kèm sentence_bert_config.json
+    return model_dir
+
+
+def get_embed_model() -> BaseEmbedding:
+    """Load dense embedding model, dùng GPU + FP16/BF16 nếu có, CPU thì ưu tiên ONNX"""
+    if torch.cuda.is_available():
+        device = "cuda"
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        model_kwargs = {"torch_dtype": dtype}
+    else:
+        if USE_ONNX_ON_CPU:
+            try:
+                model_dir = export_onnx_model()
+                print(f"🔤 Embedding device: cpu (ONNX Runtime), batch size: {EMBED_BATCH_SIZE}")
+                return OnnxEmbedding(model_dir, embed_batch_size=EMBED_BATCH_SIZE)
+            except ImportError as e:
+                print(f"⚠️ ONNX Runtime not available, fallback to PyTorch: {e}")
+        device = "cpu"
+        dtype = torch.float32
+        model_kwargs = {}
+    print(f"🔤 Embedding device: {device} ({dtype}), batch size: {EMBED_BATCH_SIZE}")
+    
+    embed_model = HuggingFaceEmbedding(
+        model_name=DENSE_MODEL_NAME, 
+        cache_folder=str(HF_CACHE_DIR),
+        device=device,
+        embed_batch_size=EMBED_BATCH_SIZE,
+        model_kwargs=model_kwargs,
+    )
+    if device == "cuda" and USE_TORCH_COMPILE:
+        compile_embed_model(embed_model)
+    return embed_model
+
+
+def compile_embed_model(embed_model: HuggingFaceEmbedding):
+    """torch.compile transformer bên trong SentenceTransformer và warmup 1 batch"""
+    transformer = embed_model._model[0]
+    transformer.auto_model = torch.compile(transformer.auto_model, dynamic=True)
+    
+    print("🔥 Warming up compiled embedding model...")
+    warmup_text = "Điều 1. Phạm vi điều chỉnh " * 64
+    embed_model.get_text_embedding_batch([warmup_text] * EMBED_BATCH_SIZE)
+
+
+def embedding_cache_key(embed_model: BaseEmbedding) -> str:
+    """Key "model" của EmbeddingCache: cùng model nhưng khác backend/dtype/độ dài cắt là vector khác"""
+    if isinstance(embed_model, OnnxEmbedding):
+        return f"{DENSE_MODEL_NAME}|onnx|fp32|{embed_model.max_length}"
+    st_model = embed_model._model
+    param = next(st_model.parameters())
+    dtype = str(param.dtype).removeprefix("torch.")
+    return f"{DENSE_MODEL_NAME}|torch-{param.device.type}|{dtype}|{st_model.max_seq_length}"
+
+
+class EmbeddingCache:
+    """Cache vector dense trên disk theo (model key, sha256(text)), lưu dạng float16 bytes"""
+    
+    def __init__(self, model_name: str, path: Path = EMBED_CACHE_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+    
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+    
+    def get_many(self, hashes: List[bytes]) -> Dict[bytes, List[float]]:
+        found = {}
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                [self.model_name, *batch],
+            )
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float16).astype(np.float32).tolist()
+        return found
+    
+    def put_many(self, hashes: List[bytes], vectors: List[List[float]]):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+            [
+                (self.model_name, h, np.asarray(v, dtype=np.float16).tobytes())
+                for h, v in zip(hashes, vectors)
+            ],
+        )
+        self.conn.commit()
+    
+    def close(self):
+        self.conn.close()
+
+
+def embed_dense_cached(embed_model: BaseEmbedding, texts: List[str], cache_key: str) -> List[List[float]]:
+    """Chỉ embed những text chưa có trong cache (re-ingest sau khi sửa nhỏ gần như tức thì)"""
+    cache = EmbeddingCache(model_name=cache_key)
+    try:
+        hashes = [EmbeddingCache.text_hash(t) for t in texts]
+        cached = cache.get_many(hashes)
+        miss_idx = [i for i, h in enumerate(hashes) if h not in cached]
+        # Embed theo độ dài giảm dần → mỗi batch dài đồng đều, ít padding.
+        # Kết quả gán lại theo hash nên thứ tự ban đầu được giữ nguyên.
+        miss_idx.sort(key=lambda i: len(texts[i]), reverse=True)
+        print(f"💾 Embedding cache: {len(texts) - len(miss_idx)} hit, {len(miss_idx)} miss")
+        
+        if miss_idx:
+            new_vectors = embed_model.get_text_embedding_batch(
+                [texts[i] for i in miss_idx], show_progress=True
+            )
+            miss_hashes = [hashes[i] for i in miss_idx]
+            cache.put_many(miss_hashes, new_vectors)
+            cached.update(zip(miss_hashes, new_vectors))
+        
+        return [cached[h] for h in hashes]
+    finally:
+        cache.close()
+
+
+def embed_sparse(
+    sparse_model: SparseTextEmbedding, texts: List[str]
+) -> Tuple[List[List[int]], List[List[float]]]:
+    """BM25 sparse vectors tính local bằng fastembed, corpus lớn thì chia cho tất cả CPU cores.
+    
+    Mỗi lần gọi với parallel, fastembed tạo pool process mới (mỗi process load lại model)
+    → gọi 1 lần cho cả corpus, không gọi theo từng batch nhỏ.
+    """
+    parallel = os.cpu_count() if len(texts) >= SPARSE_PARALLEL_MIN else None
+    indices, values = [], []
+    for vec in sparse_model.embed(texts, batch_size=SPARSE_BATCH_SIZE, parallel=parallel):
+        indices.append(vec.indices.tolist())
+        values.append(vec.values.tolist())
+    return indices, values
+
+
+async def ensure_collection(aclient: AsyncQdrantClient, collection_name: str, dim: int):
+    """Tạo collection (dense + sparse) nếu chưa có, tên vector theo chuẩn QdrantVectorStore"""
+    if await aclient.collection_exists(collection_name):
+        return
+    await aclient.create_collection(
+        collection_name=collection_name,
+        vectors_config={
+            # FP16 lưu trữ (nửa RAM/disk) + INT8 scalar quantization giữ trong RAM để search
+            DENSE_VECTOR_NAME: models.VectorParams(
+                size=dim,
+                distance=models.Distance.COSINE,
+                datatype=models.Datatype.FLOAT16,
+                on_disk=True,
+                quantization_config=models.ScalarQuantization(
+                    scalar=models.ScalarQuantizationConfig(
+                        type=models.ScalarType.INT8,
+                        always_ram=True,
+                    )
+                ),
+            ),
+        },
+        sparse_vectors_config={
+            SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF),
+        },
+    )
+    print(f"🆕 Created collection '{collection_name}' (dim={dim})")
+
+
+def build_points(
+    nodes: List[TextNode],
+    dense_vectors: List[List[float]],
+    sparse_vectors: Tuple[List[List[int]], List[List[float]]],
+) -> List[models.PointStruct]:
+    """Payload giống hệt QdrantVectorStore để backend đọc được (_node_content, metadata...)"""
+    sparse_indices, sparse_values = sparse_vectors
+    return [
+        models.PointStruct(
+            id=node.node_id,
+            vector={
+                DENSE_VECTOR_NAME: dense,
+                SPARSE_VECTOR_NAME: models.SparseVector(indices=indices, values=values),
+            },
+            payload=node_to_metadata_dict(node, remove_text=False, flat_metadata=False),
+        )
+        for node, dense, indices, values in zip(nodes, dense_vectors, sparse_indices, sparse_values)
+    ]
+
+
+async def upload_pipeline(
+    nodes: List[TextNode],
+    embed_model: BaseEmbedding,
+    aclient: AsyncQdrantClient,
+    collection_name: str,
+) -> int:
+    """Producer (embed trên thread) → Queue → consumer (upload async).
+    
+    Trong lúc batch N đang upload thì batch N+1 đã được embed, GPU/CPU
+    không phải chờ network và ngược lại.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    sparse_model = SparseTextEmbedding(SPARSE_MODEL_NAME, cache_dir=str(HF_CACHE_DIR))
+    cache_key = embedding_cache_key(embed_model)
+    
+    all_texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    
+    async def producer():
+        # Sparse cho cả corpus trong 1 lần gọi, chạy song song với các batch dense đầu tiên
+        sparse_task = asyncio.create_task(asyncio.to_thread(embed_sparse, sparse_model, all_texts))
+        try:
+            for start in range(0, len(nodes), PIPELINE_BATCH_SIZE):
+                end = start + PIPELINE_BATCH_SIZE
+                texts = all_texts[start:end]
+                dense_vectors = await asyncio.to_thread(embed_dense_cached, embed_model, texts, cache_key)
+                sparse_indices, sparse_values = await sparse_task
+                sparse_vectors = (sparse_indices[start:end], sparse_values[start:end])
+                await queue.put((nodes[start:end], dense_vectors, sparse_vectors))
+        finally:
+            if not sparse_task.done():
+                sparse_task.cancel()
+        await queue.put(None)
+    
+    async def consumer() -> int:
+        uploaded = 0
+        while (item := await queue.get()) is not None:
+            batch, dense_vectors, sparse_vectors = item
+            if uploaded == 0:
+                await ensure_collection(aclient, collection_name, dim=len(dense_vectors[0]))
+            await aclient.upload_points(
+                collection_name=collection_name,
+                points=build_points(batch, dense_vectors, sparse_vectors),
+                batch_size=UPLOAD_BATCH_SIZE,
+                wait=True,
+            )
+            uploaded += len(batch)
+            print(f"⬆️  Uploaded {uploaded}/{len(nodes)} points")
+        return uploaded
+    
+    _, uploaded = await asyncio.gather(producer(), consumer())
+    return uploaded
 
 
 def index_to_qdrant(
@@ -61,43 +450,31 @@ def index_to_qdrant(
     url: str,
     api_key: str,
     collection_name: str
-) -> VectorStoreIndex:
-    embed_model = HuggingFaceEmbedding(
-        model_name=DENSE_MODEL_NAME, 
-        cache_folder=str(HF_CACHE_DIR)
-    )
+) -> int:
+    embed_model = get_embed_model()
     Settings.embed_model = embed_model
     Settings.llm = None
     
     # ===== DISABLE CHUNKING =====
-    # Set chunk_size large enough so each article = 1 node
-    Settings.node_parser = SentenceSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP
-    )
-    print(f"📦 Chunk settings: size={CHUNK_SIZE}, overlap={CHUNK_OVERLAP}")
+    # Mỗi điều luật = 1 node, bỏ qua bước tách câu của SentenceSplitter
+    node_parser = IdentityNodeParser()
+    Settings.node_parser = node_parser
+    print("📦 Chunking: disabled (1 article = 1 node)")
     
     print(f"\n{'='*50}")
     print(f"Indexing {len(documents)} documents to '{collection_name}'")
     print(f"{'='*50}")
     
-    vector_store = QdrantVectorStore(
-        url=url,
-        api_key=api_key, 
-        collection_name=collection_name,
-        enable_hybrid=True,
-        fastembed_sparse_model=SPARSE_MODEL_NAME,
-    )
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    # Sắp xếp theo độ dài giảm dần để mỗi batch có độ dài đồng đều (ít padding)
+    documents = sorted(documents, key=lambda d: len(d.text), reverse=True)
+    nodes = node_parser.get_nodes_from_documents(documents, show_progress=True)
     
-    index = VectorStoreIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        show_progress=True
-    )
+    # ===== EMBED + UPLOAD (pipeline) =====
+    aclient = AsyncQdrantClient(url=url, api_key=api_key, prefer_grpc=True, grpc_port=QDRANT_GRPC_PORT)
+    uploaded = asyncio.run(upload_pipeline(nodes, embed_model, aclient, collection_name))
     
-    print(f"Done indexing '{collection_name}'")
-    return index
+    print(f"Done indexing '{collection_name}': {uploaded} points")
+    return uploaded
 
 
 def main():
@@ -111,12 +488,12 @@ def main():
     print(f"Qdrant URL: {QDRANT_URL}")
     print(f"Collection: {COLLECTION_NAME}")
     print(f"Data file: {JSON_FILE_PATH}")
-    print(f"Chunk size: {CHUNK_SIZE} tokens (no chunking)")
+    print("Chunking: disabled (1 article = 1 node)")
     
-    data = load_data(str(JSON_FILE_PATH))
-    documents = create_documents(data)
+    documents = create_documents(load_data(str(JSON_FILE_PATH)))
+    print(f"Loaded: {len(documents)} documents")
     
-    index = index_to_qdrant(
+    uploaded = index_to_qdrant(
         documents=documents,
         url=QDRANT_URL,
         api_key=QDRANT_API_KEY,
@@ -125,7 +502,7 @@ def main():
     
     print("\n" + "="*50)
     print("ALL DONE!")
-    print(f"Collection '{COLLECTION_NAME}': {len(documents)} documents")
+    print(f"Collection '{COLLECTION_NAME}': {len(documents)} documents, {uploaded} points")
     print("="*50)
 
 
@@ -6,16 +6,20 @@ Post-processing script: Xử lý legal_decrees.json sau khi chạy processing.py
 Chạy: python ND293_process.py
 """
 import json
+import orjson
+import argparse
+from json.decoder import scanstring
+from pathlib import Path
+from typing import Optional
+import numpy as np
 
 INPUT_FILE = './legal_decrees.json'
 OUTPUT_FILE = './legal_decrees.json'  
 
+ND293_DOC_NUMBER = '293/2025/NĐ-CP'
+ND293_ARTICLE_ID = '5'
 
-def fix_nd293_dieu5(data: list) -> bool:
-    for item in data:
-        meta = item['metadata']
-        if meta['doc_number'] == '293/2025/NĐ-CP' and meta['article_id'] == '5':
-            new_content = """[Nghị định về mức lương tối thiểu vùng 2026]
+ND293_DIEU5_CONTENT = """[Nghị định về mức lương tối thiểu vùng 2026]
 [Quy định chung]
 Điều 5. Hiệu lực và trách nhiệm thi hành
 1. Nghị định này có hiệu lực thi hành từ ngày 01 tháng 01 năm 2026.
@@ -35,6 +39,13 @@ DANH MỤC ĐỊA BÀN ÁP DỤNG MỨC LƯƠNG TỐI THIỂU (TÓM TẮT):
 
 Lưu ý: Danh mục chi tiết từng xã/phường xem Phụ lục Nghị định 293/2025/NĐ-CP."""
 
+
+def fix_nd293_dieu5(data: list) -> bool:
+    for item in data:
+        meta = item['metadata']
+        if meta['doc_number'] == ND293_DOC_NUMBER and meta['article_id'] == ND293_ARTICLE_ID:
+            new_content = ND293_DIEU5_CONTENT
+
             old_len = len(item['page_content'])
             item['page_content'] = new_content
             print(f"Đã sửa NĐ 293 Điều 5: {old_len:,} → {len(new_content):,} ký tự")
@@ -42,33 +53,73 @@ Lưu ý: Danh mục chi tiết từng xã/phường xem Phụ lục Nghị đị
     return False
 
 
+def patch_nd293_dieu5_raw(text: str) -> Optional[str]:
+    """Thay page_content của NĐ 293 Điều 5 trực tiếp trên text JSON (không dump lại cả file).
+    
+    File được ghi bởi json.dump(indent=2) nên mỗi record có dạng
+    {"page_content": "...", "metadata": {...}} → tìm doc_number, lùi về
+    "page_content" gần nhất và đọc chuỗi JSON bằng scanstring (xử lý escape).
+    """
+    doc_key = '"doc_number": ' + json.dumps(ND293_DOC_NUMBER, ensure_ascii=False)
+    article_key = '"article_id": ' + json.dumps(ND293_ARTICLE_ID)
+    content_key = '"page_content": '
+    
+    pos = text.find(doc_key)
+    while pos != -1:
+        record_end = text.find(content_key, pos)
+        article_pos = text.find(article_key, pos, record_end if record_end != -1 else len(text))
+        if article_pos != -1:
+            value_start = text.rfind(content_key, 0, pos) + len(content_key)
+            old_content, value_end = scanstring(text, value_start + 1)
+            print(f"Đã sửa NĐ 293 Điều 5: {len(old_content):,} → {len(ND293_DIEU5_CONTENT):,} ký tự")
+            return text[:value_start] + json.dumps(ND293_DIEU5_CONTENT, ensure_ascii=False) + text[value_end:]
+        pos = text.find(doc_key, pos + len(doc_key))
+    return None
+
+
 def check_long_chunks(data: list, threshold: int = 10000):
+    lengths = np.fromiter((len(item['page_content']) for item in data), dtype=np.int64, count=len(data))
     long_chunks = []
-    for item in data:
-        length = len(item['page_content'])
-        if length > threshold:
-            meta = item['metadata']
-            long_chunks.append({
-                'doc_name': meta['doc_name'],
-                'article_id': meta['article_id'],
-                'length': length
-            })
+    for idx in np.flatnonzero(lengths > threshold):
+        meta = data[idx]['metadata']
+        long_chunks.append({
+            'doc_name': meta['doc_name'],
+            'article_id': meta['article_id'],
+            'length': int(lengths[idx])
+        })
     return long_chunks
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Post-process legal_decrees.json")
+    parser.add_argument("--safe", action="store_true", help="Load toàn bộ JSON, sửa rồi dump lại cả file")
+    args = parser.parse_args()
+    
     print("="*60)
     print("POST-PROCESSING legal_decrees.json")
     print("="*60)
-    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    print(f"\nLoaded {len(data)} chunks from {INPUT_FILE}")
     
-    # Fix NĐ 293 Điều 5
-    print("\n Xử lý NĐ 293 Điều 5 (cắt PHỤ LỤC)...")
-    fixed = fix_nd293_dieu5(data)
-    if not fixed:
-        print(" Không tìm thấy NĐ 293 Điều 5")
+    if args.safe:
+        data = orjson.loads(Path(INPUT_FILE).read_bytes())
+        print(f"\nLoaded {len(data)} chunks from {INPUT_FILE}")
+        
+        # Fix NĐ 293 Điều 5
+        print("\n Xử lý NĐ 293 Điều 5 (cắt PHỤ LỤC)...")
+        fixed = fix_nd293_dieu5(data)
+        if not fixed:
+            print(" Không tìm thấy NĐ 293 Điều 5")
+    else:
+        # Chỉ thay đúng đoạn page_content cần sửa, phần còn lại giữ nguyên
+        text = Path(INPUT_FILE).read_text(encoding='utf-8')
+        print("\n Xử lý NĐ 293 Điều 5 (cắt PHỤ LỤC)...")
+        patched = patch_nd293_dieu5_raw(text)
+        fixed = patched is not None
+        if fixed:
+            text = patched
+        else:
+            print(" Không tìm thấy NĐ 293 Điều 5")
+        data = orjson.loads(text)
+        print(f"\nLoaded {len(data)} chunks from {INPUT_FILE}")
     
     # Kiểm tra chunks dài
     print("\n Kiểm tra chunks > 10,000 ký tự:")
@@ -78,8 +129,11 @@ def main():
             print(f" - {chunk['doc_name']} Điều {chunk['article_id']}: {chunk['length']:,} ký tự")
     else:
         print(" Không có chunks > 10,000 ký tự")
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    
+    if args.safe:
+        Path(OUTPUT_FILE).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    elif fixed:
+        Path(OUTPUT_FILE).write_text(text, encoding='utf-8')
     
     print("\n" + "="*60)
     print("HOÀN TẤT POST-PROCESSING")
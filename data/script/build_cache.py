@@ -0,0 +1,78 @@
+"""
+Build cached DataFrame (legal_decrees.parquet) cho các script EDA
+Parse JSON + đếm token 1 lần, các lần chạy EDA sau chỉ cần đọc parquet
+"""
+import ijson
+import os
+import numpy as np
+import pandas as pd
+import tiktoken
+
+JSON_PATH = "legal_decrees.json"
+PARQUET_PATH = "legal_decrees.parquet"
+
+META_COLUMNS = ("doc_type", "doc_name", "short_name", "chapter", "article_id", "article_title", "effective_date")
+
+
+def build_dataframe(json_path: str = JSON_PATH) -> pd.DataFrame:
+    # Load data (stream từng record), gom thẳng vào từng cột thay vì list dict theo dòng
+    print("📊 Loading data...")
+    texts = []
+    meta_columns = {col: [] for col in META_COLUMNS}
+    with open(json_path, "rb") as f:
+        for d in ijson.items(f, "item"):
+            texts.append(d["page_content"])
+            meta = d["metadata"]
+            for col, values in meta_columns.items():
+                values.append(meta[col])
+
+    df = pd.DataFrame({
+        "text": texts,
+        **meta_columns,
+        "char_count": np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)),
+        "word_count": np.fromiter((len(t.split()) for t in texts), dtype=np.int64, count=len(texts)),
+    })
+
+    print(f"✅ Loaded {len(df)} documents")
+
+    # Token counting
+    print("📝 Counting tokens...")
+    try:
+        enc = tiktoken.get_encoding("cl100k_base")
+        # encode_batch chạy song song trên thread pool (Rust, nhả GIL)
+        token_ids = enc.encode_batch(texts, num_threads=os.cpu_count())
+        df["token_count"] = np.fromiter(map(len, token_ids), dtype=np.int64, count=len(token_ids))
+    except:
+        # Approximate: 1 token ≈ 4 chars for Vietnamese
+        df["token_count"] = df["char_count"] // 4
+
+    print(f"✅ Token counting done")
+    return df
+
+
+def write_cache(df: pd.DataFrame, parquet_path: str = PARQUET_PATH):
+    """Ghi parquet (pyarrow, zstd); thiếu pyarrow thì bỏ qua cache"""
+    try:
+        df.to_parquet(parquet_path, engine="pyarrow", compression="zstd", row_group_size=1000, index=False)
+        print(f"💾 Saved cache: {parquet_path}")
+    except ImportError:
+        print("⚠️ pyarrow not installed, skipping parquet cache")
+
+
+def load_cached_dataframe(json_path: str = JSON_PATH, parquet_path: str = PARQUET_PATH) -> pd.DataFrame:
+    """Đọc parquet nếu mới hơn file JSON, ngược lại build lại và ghi cache"""
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(json_path):
+        try:
+            df = pd.read_parquet(parquet_path, engine="pyarrow")
+            print(f"✅ Loaded {len(df)} documents from cache: {parquet_path}")
+            return df
+        except ImportError:
+            print("⚠️ pyarrow not installed, rebuilding from JSON")
+
+    df = build_dataframe(json_path)
+    write_cache(df, parquet_path)
+    return df
+
+
+if __name__ == "__main__":
+    write_cache(build_dataframe())
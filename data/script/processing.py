@@ -1,10 +1,55 @@
 import re
 from docx import Document
-import json
+import orjson
 from typing import List, Dict, Optional
 from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
 
+# ===== REGEX PATTERNS (compile 1 lần khi load module) =====
+# Ứng viên tiêu đề chương; phần tiêu đề IN HOA được lọc bằng str.isupper()
+# thay vì liệt kê toàn bộ chữ hoa tiếng Việt trong character class
+_CHAPTER_RE = re.compile(r"^(Chương [IVXLCDM]+)\.?\s*\n?([^\W\d_][^\n]*)", re.MULTILINE)
+_APPENDIX_RE = re.compile(r"\n(PHỤ LỤC\s*\n|PHỤ LỤC:)", re.IGNORECASE)
+# "số. Tỉnh/Thành phố Tên"
+_PROVINCE_RE = re.compile(r"(\d+)\.\s*(Tỉnh|Thành phố)\s+([^\n]+)")
+# Ranh giới Điều: lần xuất hiện đầu tiên của "Điều N." + mỗi "\nĐiều N." sau đó
+_ARTICLE_FIRST_RE = re.compile(r"Điều (\d+)\.")
+_ARTICLE_BOUNDARY_RE = re.compile(r"\nĐiều (\d+)\.")
+# Tiêu đề Điều ngay sau "Điều N." (match giới hạn trong phạm vi của Điều)
+_ARTICLE_TITLE_RE = re.compile(r"\s*([^\n]+)")
+# Bảng Nơi nhận markdown
+_CLEAN_BLOCK_RE = re.compile(r"\| Nơi nhận:.*?\| --- \| --- \|", re.DOTALL)
+# Bảng Nơi nhận / chữ ký Chính phủ / KT. Thủ tướng → cắt từ vị trí sớm nhất đến cuối
+_CLEAN_TAIL_RE = re.compile(r"\n\| Nơi nhận:|TM\. CHÍNH PHỦ|KT\. THỦ TƯỚNG")
+_INTERNAL_REF_RE = re.compile(r"(?:khoản \d+\s+)?Điều (\d+)")
+# Giữ riêng từng pattern: các match có thể chồng lên nhau
+# (VD "Luật ... và Bộ luật Lao động 2019"), 1 alternation sẽ bỏ sót
+_EXTERNAL_REF_RES = tuple(re.compile(p) for p in (
+    r"Luật [^,\.;]+\d{4}",
+    r"Bộ luật [^,\.;]+\d{4}",
+    r"Nghị định số \d+/\d+/NĐ-CP",
+    r"Thông tư số \d+/\d+/TT-[A-Z]+",
+))
+
+def _find_chapters(text: str) -> List[tuple]:
+    """Trả về (start, end, "Chương X. TIÊU ĐỀ") cho từng tiêu đề chương"""
+    chapters = []
+    for match in _CHAPTER_RE.finditer(text):
+        line = match.group(2)
+        if not line[0].isupper():
+            continue
+        # Tiêu đề = đoạn đầu dòng gồm chữ in hoa, dấu phẩy, khoảng trắng
+        n = 1
+        while n < len(line) and (line[n].isupper() or line[n] in ", "):
+            n += 1
+        if n < 2:
+            continue
+        chapters.append((match.start(), match.start(2) + n, f"{match.group(1)}. {line[:n].strip()}"))
+    return chapters
+
+
 @dataclass
 class DocumentInfo:
     doc_type: str
@@ -18,6 +63,18 @@ class DocumentInfo:
 class LegalDocumentParser:    
     def __init__(self, doc_info: DocumentInfo):
         self.doc_info = doc_info
+        # Metadata chung của văn bản, dựng 1 lần (giữ nguyên thứ tự key trong JSON)
+        self._head_meta = {
+            "doc_type": doc_info.doc_type,
+            "doc_number": doc_info.doc_number,
+            "doc_name": doc_info.doc_name,
+            "short_name": doc_info.short_name,
+        }
+        self._tail_meta = {
+            "effective_date": doc_info.effective_date,
+            "status": doc_info.status,
+        }
+        self._content_prefix = f"[{doc_info.doc_name}]\n"
         
     def parse(self, text: str) -> List[Dict]:
         chunks = []
@@ -26,27 +83,20 @@ class LegalDocumentParser:
         main_text, appendix_text = self._split_appendix(text)
         
         # Parse phần Điều như cũ
-        chapter_header_pattern = r"^(Chương [IVXLCDM]+)\.?\s*\n?([A-ZĐÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ][A-ZĐÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ, ]+)"
-        
-        chapter_matches = list(re.finditer(chapter_header_pattern, main_text, re.MULTILINE))
+        chapters = _find_chapters(main_text)
         
-        if not chapter_matches:
+        if not chapters:
             current_chapter = "Quy định chung"
             self._parse_articles(main_text, current_chapter, chunks)
         else:
-            first_chapter_start = chapter_matches[0].start()
+            first_chapter_start = chapters[0][0]
             if first_chapter_start > 0:
                 before_first = main_text[:first_chapter_start]
                 self._parse_articles(before_first, "Quy định chung", chunks)
             
-            for i, match in enumerate(chapter_matches):
-                chapter_num = match.group(1) 
-                chapter_title = match.group(2).strip() 
-                current_chapter = f"{chapter_num}. {chapter_title}"
-
-                start_pos = match.end()
-                if i + 1 < len(chapter_matches):
-                    end_pos = chapter_matches[i + 1].start()
+            for i, (_, start_pos, current_chapter) in enumerate(chapters):
+                if i + 1 < len(chapters):
+                    end_pos = chapters[i + 1][0]
                 else:
                     end_pos = len(main_text)
                 
@@ -63,19 +113,11 @@ class LegalDocumentParser:
     def _split_appendix(self, text: str) -> tuple:
         """Tách phần chính và phụ lục"""
         # Tìm vị trí bắt đầu phụ lục
-        appendix_patterns = [
-            r"\n(PHỤ LỤC\s*\n)",
-            r"\n(Phụ lục\s*\n)",
-            r"\n(PHỤ LỤC:)",
-            r"\n(Phụ lục:)",
-        ]
-        
-        for pattern in appendix_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                main_text = text[:match.start()]
-                appendix_text = text[match.start():]
-                return main_text, appendix_text
+        match = _APPENDIX_RE.search(text)
+        if match:
+            main_text = text[:match.start()]
+            appendix_text = text[match.start():]
+            return main_text, appendix_text
         
         return text, ""
     
@@ -83,9 +125,8 @@ class LegalDocumentParser:
         """Parse phụ lục thành chunks theo tỉnh/thành phố"""
         chunks = []
         
-        # Pattern tìm từng tỉnh/thành phố: "số. Tỉnh/Thành phố Tên"
-        province_pattern = r"(\d+)\.\s*(Tỉnh|Thành phố)\s+([^\n]+)"
-        matches = list(re.finditer(province_pattern, appendix_text))
+        # Tìm từng tỉnh/thành phố
+        matches = list(_PROVINCE_RE.finditer(appendix_text))
         
         if not matches:
             # Không tìm thấy tỉnh → tạo 1 chunk cho toàn bộ phụ lục
@@ -128,113 +169,109 @@ class LegalDocumentParser:
         if not content.strip():
             return None
         
-        page_content = f"""[{self.doc_info.doc_name}]
-[Phụ lục - {appendix_title}]
+        page_content = f"""{self._content_prefix}[Phụ lục - {appendix_title}]
 {content}"""
         
         return {
             "page_content": page_content,
             "metadata": {
-                "doc_type": self.doc_info.doc_type,
-                "doc_number": self.doc_info.doc_number,
-                "doc_name": self.doc_info.doc_name,
-                "short_name": self.doc_info.short_name,
+                **self._head_meta,
                 "chapter": "Phụ lục",
                 "article_id": appendix_id,
                 "article_title": appendix_title,
-                "effective_date": self.doc_info.effective_date,
-                "status": self.doc_info.status,
+                **self._tail_meta,
                 "references": [],
             }
         }
     
     def _parse_articles(self, text: str, chapter: str, chunks: List[Dict]):
-        article_pattern = r"(Điều \d+\..*?)(?=\nĐiều \d+\.|$)"
-        articles = re.findall(article_pattern, text, re.DOTALL)
+        first = _ARTICLE_FIRST_RE.search(text)
+        if not first:
+            return
         
-        for article in articles:
-            chunk = self._create_chunk(article, chapter)
+        # Cắt text theo offset của các match thay vì regex lazy ".*?" + lookahead
+        heads = [first]
+        heads.extend(_ARTICLE_BOUNDARY_RE.finditer(text, first.start()))
+        starts = [first.start()] + [h.start() + 1 for h in heads[1:]]
+        ends = [start - 1 for start in starts[1:]]
+        ends.append(len(text) - 1 if text.endswith("\n") else len(text))
+        
+        for head, start, end in zip(heads, starts, ends):
+            title_match = _ARTICLE_TITLE_RE.match(text, head.end(), end)
+            if not title_match:
+                continue
+            chunk = self._create_chunk(
+                text[start:end], head.group(1), title_match.group(1).strip(), chapter
+            )
             if chunk:
                 chunks.append(chunk)
     
     def _clean_article(self, article: str) -> str:
         """Loại bỏ footer/signature không cần thiết"""
         # Loại bỏ bảng "Nơi nhận" và chữ ký
-        patterns_to_remove = [
-            r"\| Nơi nhận:.*?\| --- \| --- \|",  # Bảng Nơi nhận markdown
-            r"\n\| Nơi nhận:.*$",  # Bảng Nơi nhận đến cuối
-            r"TM\. CHÍNH PHỦ.*$",  # Chữ ký Chính phủ
-            r"KT\. THỦ TƯỚNG.*$",  # KT. Thủ tướng  
-        ]
-        
-        cleaned = article
-        for pattern in patterns_to_remove:
-            cleaned = re.sub(pattern, "", cleaned, flags=re.DOTALL | re.MULTILINE)
+        cleaned = _CLEAN_BLOCK_RE.sub("", article)
+        tail = _CLEAN_TAIL_RE.search(cleaned)
+        if tail:
+            cleaned = cleaned[:tail.start()]
         
         return cleaned.strip()
     
-    def _create_chunk(self, article: str, chapter: str) -> Optional[Dict]:
-        header_match = re.match(r"Điều (\d+)\.\s*([^\n]+)", article)
-        if not header_match:
-            return None
-        article_id = header_match.group(1)
-        article_title = header_match.group(2).strip()
-        
+    def _create_chunk(self, article: str, article_id: str, article_title: str, chapter: str) -> Optional[Dict]:
         # Clean article content
         cleaned_article = self._clean_article(article)
         references = self._extract_references(cleaned_article, article_id)
         
-        page_content = f"""[{self.doc_info.doc_name}]
-[{chapter}]
+        page_content = f"""{self._content_prefix}[{chapter}]
 {cleaned_article}"""
         
         return {
             "page_content": page_content,
             "metadata": {
-                "doc_type": self.doc_info.doc_type,
-                "doc_number": self.doc_info.doc_number,
-                "doc_name": self.doc_info.doc_name,
-                "short_name": self.doc_info.short_name,
+                **self._head_meta,
                 "chapter": chapter,
                 "article_id": article_id,
                 "article_title": article_title,
-                "effective_date": self.doc_info.effective_date,
-                "status": self.doc_info.status,
+                **self._tail_meta,
                 "references": references,
             }
         }
     
     def _extract_references(self, text: str, current_article_id: str = None) -> List[str]:
-        refs = set()
-        
-        internal = re.findall(r"(?:khoản \d+\s+)?Điều (\d+)", text)
-        for r in internal:
-            if current_article_id is None or r != current_article_id:
-                refs.add(f"Điều {r}")
-        
-        external_patterns = [
-            r"(Luật [^,\.;]+\d{4})",
-            r"(Bộ luật [^,\.;]+\d{4})",
-            r"(Nghị định số \d+/\d+/NĐ-CP)",
-            r"(Thông tư số \d+/\d+/TT-[A-Z]+)",
-        ]
-        for pattern in external_patterns:
-            matches = re.findall(pattern, text)
-            refs.update(matches)
+        refs = {
+            f"Điều {m.group(1)}"
+            for m in _INTERNAL_REF_RE.finditer(text)
+            if m.group(1) != current_article_id
+        }
+        refs.update(m.group(0) for pattern in _EXTERNAL_REF_RES for m in pattern.finditer(text))
         
         return list(refs)
 
 
-def table_to_text(table) -> str:
-    """Chuyển table trong docx thành text dạng markdown"""
+# Xuống dòng / tab trong ô → khoảng trắng (1 lượt translate thay vì replace)
+_CELL_TRANS = str.maketrans({'\n': ' ', '\r': ' ', '\t': ' '})
+
+
+def _cell_texts(tr) -> List[str]:
+    """Text của từng ô trong 1 hàng <w:tr> (ô gộp ngang lặp lại theo gridSpan,
+    ô gộp dọc lấy nội dung ô gốc phía trên — giống docx.table._Row.cells)"""
+    texts = []
+    for tc in tr.tc_lst:
+        root = tc
+        while root.vMerge == "continue":
+            root = root._tc_above
+        text = "\n".join(p.text for p in root.p_lst)
+        texts.extend([text] * tc.grid_span)
+    return texts
+
+
+def table_to_text(tbl) -> str:
+    """Chuyển table (<w:tbl>) trong docx thành text dạng markdown"""
     lines = []
-    for i, row in enumerate(table.rows):
-        cells = [cell.text.strip().replace('\n', ' ') for cell in row.cells]
-        line = "| " + " | ".join(cells) + " |"
-        lines.append(line)
+    for i, tr in enumerate(tbl.tr_lst):
+        texts = _cell_texts(tr)
+        lines.append("| " + " | ".join(text.strip().translate(_CELL_TRANS) for text in texts) + " |")
         if i == 0:
-            separator = "| " + " | ".join(["---"] * len(cells)) + " |"
-            lines.append(separator)
+            lines.append("| " + " | ".join(["---"] * len(texts)) + " |")
     return "\n".join(lines)
 
 
@@ -243,17 +280,16 @@ def read_docx(path: str) -> str:
     content_parts = []
     
     from docx.oxml.ns import qn
-    from docx.text.paragraph import Paragraph
-    from docx.table import Table as DocxTable
     
+    # Đọc thẳng trên các element oxml (lxml), không dựng Paragraph/Table wrapper
+    p_tag, tbl_tag = qn('w:p'), qn('w:tbl')
     for child in doc.element.body:
-        if child.tag == qn('w:p'):
-            para = Paragraph(child, doc)
-            if para.text.strip():
-                content_parts.append(para.text)
-        elif child.tag == qn('w:tbl'):
-            tbl = DocxTable(child, doc)
-            table_text = table_to_text(tbl)
+        if child.tag == p_tag:
+            text = child.text
+            if text.strip():
+                content_parts.append(text)
+        elif child.tag == tbl_tag:
+            table_text = table_to_text(child)
             if table_text.strip():
                 content_parts.append("\n" + table_text + "\n")
     
@@ -343,29 +379,44 @@ DOCUMENTS = [
 ]
 
 
+def _process_one(doc_config: Dict, law_dir: str, decree_dir: str) -> Optional[List[Dict]]:
+    """Đọc + parse 1 file docx (chạy trong worker process)"""
+    if doc_config["doc_info"].doc_type == "luật":
+        filepath = os.path.join(law_dir, doc_config["filename"])
+    else:
+        filepath = os.path.join(decree_dir, doc_config["filename"])
+        
+    if not os.path.exists(filepath):
+        print(f"❌ File not found: {filepath}")
+        return None
+        
+    text = read_docx(filepath)
+    parser = LegalDocumentParser(doc_config["doc_info"])
+    return parser.parse(text)
+
+
 def process_all_documents(law_dir: str, decree_dir: str) -> List[Dict]:
     all_chunks = []
     
-    for doc_config in DOCUMENTS:
-        if doc_config["doc_info"].doc_type == "luật":
-            filepath = os.path.join(law_dir, doc_config["filename"])
-        else:
-            filepath = os.path.join(decree_dir, doc_config["filename"])
+    # Các file độc lập → đọc + parse song song, map() giữ nguyên thứ tự DOCUMENTS
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            _process_one,
+            DOCUMENTS,
+            repeat(law_dir),
+            repeat(decree_dir),
+            chunksize=1,
+        )
+        for doc_config, chunks in zip(DOCUMENTS, results):
+            if chunks is None:
+                continue
             
-        if not os.path.exists(filepath):
-            print(f"❌ File not found: {filepath}")
-            continue
+            # Đếm số điều và phụ lục (1 lượt, không tạo list trung gian)
+            n_appendix = sum(c['metadata']['article_id'].startswith('PL_') for c in chunks)
+            n_articles = len(chunks) - n_appendix
             
-        text = read_docx(filepath)
-        parser = LegalDocumentParser(doc_config["doc_info"])
-        chunks = parser.parse(text)
-        
-        # Đếm số điều và phụ lục
-        articles = [c for c in chunks if not c['metadata']['article_id'].startswith('PL_')]
-        appendix = [c for c in chunks if c['metadata']['article_id'].startswith('PL_')]
-        
-        all_chunks.extend(chunks)
-        print(f"✅ {doc_config['doc_info'].short_name}: {len(articles)} điều, {len(appendix)} phụ lục")
+            all_chunks.extend(chunks)
+            print(f"✅ {doc_config['doc_info'].short_name}: {n_articles} điều, {n_appendix} phụ lục")
     
     return all_chunks
 
@@ -387,8 +438,7 @@ if __name__ == "__main__":
     
     chunks = process_all_documents(str(LAW_DIR), str(DECREE_DIR))
     
-    with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-        json.dump(chunks, f, ensure_ascii=False, indent=2)
+    OUTPUT_PATH.write_bytes(orjson.dumps(chunks, option=orjson.OPT_INDENT_2))
     
     print(f"\n📊 Total: {len(chunks)} chunks")
     print(f"💾 Saved to: {OUTPUT_PATH}")
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Explicit context caching của Gemini (cachedContents API)
+Upload system prompt 1 lần, các request generateContent chỉ tham chiếu tên cache
+"""
+from typing import Dict, Optional
+
+import httpx
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+PROMPT_CACHE_TTL = "3600s"
+
+
+async def create_prompt_cache(
+    client: httpx.AsyncClient, api_key: str, model: str, system_prompt: str
+) -> Optional[str]:
+    """Tạo cachedContent chứa system prompt → tên cache, None nếu API từ chối
+
+    API yêu cầu số token tối thiểu cho mỗi cache (prompt ngắn sẽ bị từ chối),
+    khi đó caller tiếp tục gửi systemInstruction inline như cũ.
+    """
+    try:
+        resp = await client.post(
+            f"{GEMINI_API_BASE}/cachedContents?key={api_key}",
+            json={
+                "model": f"models/{model}",
+                "systemInstruction": {"parts": [{"text": system_prompt}]},
+                "ttl": PROMPT_CACHE_TTL,
+            },
+        )
+        data = resp.json()
+    except Exception as e:
+        print(f"⚠️ Gemini prompt cache unavailable ({e}), sending system prompt inline")
+        return None
+
+    if "name" not in data:
+        message = data.get("error", {}).get("message", "unknown error")
+        print(f"⚠️ Gemini prompt cache unavailable ({message}), sending system prompt inline")
+        return None
+
+    print(f"✅ Gemini prompt cache: {data['name']}")
+    return data["name"]
+
+
+async def delete_prompt_cache(client: httpx.AsyncClient, api_key: str, name: str):
+    """Xoá cache khi chạy xong (không chờ hết TTL)"""
+    try:
+        await client.delete(f"{GEMINI_API_BASE}/{name}?key={api_key}")
+    except Exception as e:
+        print(f"⚠️ Failed to delete Gemini prompt cache {name}: {e}")
+
+
+def cached_body_base(base_body: Dict, cache_name: str) -> Dict:
+    """Request body cố định khi dùng cache: thay systemInstruction bằng cachedContent"""
+    body = {k: v for k, v in base_body.items() if k != "systemInstruction"}
+    body["cachedContent"] = cache_name
+    return body
@@ -0,0 +1,57 @@
+"""
+Cache response của API bên ngoài (Gemini, SerpAPI) trên disk
+Key = sha256 của payload (model, prompt, câu hỏi, ...), mỗi namespace 1 file SQLite
+"""
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+CACHE_DIR = Path(__file__).parent.resolve() / ".cache"
+
+_connections: Dict[str, sqlite3.Connection] = {}
+
+
+def _get_conn(namespace: str) -> sqlite3.Connection:
+    """1 connection cho mỗi namespace, tạo lần đầu dùng"""
+    conn = _connections.get(namespace)
+    if conn is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(CACHE_DIR / f"{namespace}.sqlite")
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        _connections[namespace] = conn
+    return conn
+
+
+def make_key(payload: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+async def cached_call(
+    namespace: str,
+    key_payload: Any,
+    coro_factory: Callable[[], Awaitable[Any]],
+    should_cache: Callable[[Any], bool] = lambda value: True,
+) -> Tuple[Any, bool]:
+    """Trả về (value, cached). Miss → gọi coro_factory() và lưu nếu should_cache(value).
+
+    SQLite local chỉ mất vài trăm µs mỗi lần đọc/ghi nên chạy thẳng trên event loop.
+    """
+    conn = _get_conn(namespace)
+    key = make_key(key_payload)
+
+    row = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        return json.loads(row[0]), True
+
+    value = await coro_factory()
+    if should_cache(value):
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+    return value, False
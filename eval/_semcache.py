@@ -0,0 +1,95 @@
+"""
+Semantic cache: trả lại response cũ cho câu hỏi gần trùng (paraphrase)
+Embedding local (multilingual MiniLM), cosine >= SEMCACHE_THRESHOLD là hit
+Lưu trên disk cạnh cache exact: <namespace>_<context>.npz (embedding) + .json (câu hỏi, response)
+"""
+import json
+import threading
+from typing import Any, List, Optional
+
+import numpy as np
+
+from _llm_cache import CACHE_DIR, make_key
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+    print("⚠️ sentence-transformers not installed, semantic cache disabled")
+
+SEMCACHE_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+SEMCACHE_THRESHOLD = 0.92
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def _get_model():
+    """Load model 1 lần cho mọi namespace"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = SentenceTransformer(SEMCACHE_MODEL, device="cpu")
+    return _model
+
+
+class SemanticCache:
+    """Cache theo độ tương đồng câu hỏi. context = các tham số ảnh hưởng response (model, prompt, ...)"""
+
+    def __init__(self, namespace: str, context: Any = None):
+        stem = f"{namespace}_{make_key(context)[:12]}"
+        self.emb_path = CACHE_DIR / f"{stem}.npz"
+        self.data_path = CACHE_DIR / f"{stem}.json"
+        self.enabled = SentenceTransformer is not None
+        self._lock = threading.Lock()
+        self._questions: List[str] = []
+        self._values: List[Any] = []
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._dirty = False
+
+        try:
+            with np.load(self.emb_path) as npz:
+                matrix = npz["embeddings"]
+            with open(self.data_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        if len(data["questions"]) == len(matrix):
+            self._questions, self._values, self._matrix = data["questions"], data["values"], matrix
+
+    def _encode(self, question: str) -> np.ndarray:
+        return _get_model().encode(question, normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, question: str) -> Optional[Any]:
+        """Response của câu hỏi gần nhất nếu cosine >= ngưỡng, ngược lại None (chạy trong thread)"""
+        if not self.enabled or not self._values:
+            return None
+        q = self._encode(question)
+        with self._lock:
+            # Embedding đã normalize → cosine = dot product, 1 phép matmul cho cả cache
+            scores = self._matrix @ q
+            best = int(np.argmax(scores))
+            if scores[best] >= SEMCACHE_THRESHOLD:
+                return self._values[best]
+        return None
+
+    def add(self, question: str, value: Any):
+        if not self.enabled:
+            return
+        q = self._encode(question)
+        with self._lock:
+            self._matrix = np.vstack([self._matrix.reshape(-1, q.shape[0]), q])
+            self._questions.append(question)
+            self._values.append(value)
+            self._dirty = True
+
+    def save(self):
+        """Ghi ra disk (gọi 1 lần cuối run)"""
+        if not self._dirty:
+            return
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            np.savez(self.emb_path, embeddings=self._matrix)
+            with open(self.data_path, "w", encoding="utf-8") as f:
+                json.dump({"questions": self._questions, "values": self._values}, f, ensure_ascii=False)
+            self._dirty = False
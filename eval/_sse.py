@@ -0,0 +1,17 @@
+"""
+Decode SSE payload của endpoint /chat bằng msgspec (typed struct, bỏ qua field không dùng)
+"""
+from typing import Any, Dict, List, Optional
+
+import msgspec
+
+
+class RagEvent(msgspec.Struct, kw_only=True):
+    token: Optional[str] = None
+    nodes: Optional[List[Dict[str, Any]]] = None
+
+
+_RAG_EVENT_DECODER = msgspec.json.Decoder(RagEvent)
+
+decode_rag_event = _RAG_EVENT_DECODER.decode
+DecodeError = msgspec.DecodeError
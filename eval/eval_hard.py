@@ -8,17 +8,31 @@ Usage:
     python eval_hard.py                    # Run all hard cases
     python eval_hard.py --file hard        # Specific file
 """
-import json
+import orjson
 import httpx
+from aiolimiter import AsyncLimiter
+import numpy as np
 import asyncio
 import os
+import sys
 import re
 import argparse
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass, asdict, field
+from time import perf_counter
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from _gemini_prompt_cache import cached_body_base, create_prompt_cache, delete_prompt_cache
+from _sse import DecodeError, decode_rag_event
+
+try:
+    import h2  # noqa: F401  (HTTP/2 cho httpx)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+    print("⚠️ h2 not installed, using HTTP/1.1 (pip install 'httpx[http2]')")
 
 # Auto-resolve paths from script location
 SCRIPT_DIR = Path(__file__).parent.resolve()
@@ -32,12 +46,43 @@ load_dotenv(ENV_FILE)
 RAG_API_URL = os.getenv("RAG_API_URL", "http://localhost:8000")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = "gemini-2.5-flash"
+EVAL_CONCURRENCY = 4  # Số test case chạy song song (giới hạn theo rate limit)
+# Giới hạn request/phút tới Gemini (free tier ~15 RPM)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_LIMITER = AsyncLimiter(GEMINI_RPM, 60)
+PROGRESS_FLUSH_EVERY = 10  # flush stdout mỗi N kết quả thay vì mỗi dòng print
 
 GEMINI_SYSTEM_PROMPT = """Bạn là chuyên gia pháp luật lao động Việt Nam.
 Trả lời chính xác, đầy đủ từng câu hỏi con.
 Trích dẫn Điều, Khoản cụ thể từ văn bản pháp luật.
 Khi tính toán, trình bày công thức và kết quả rõ ràng."""
 
+# Phần cố định của request body, mỗi lần gọi chỉ ghép thêm câu hỏi
+_GEMINI_BASE_BODY = {
+    "systemInstruction": {"parts": [{"text": GEMINI_SYSTEM_PROMPT}]},
+    "generationConfig": {
+        "temperature": 0.05,
+        "maxOutputTokens": 4024
+    }
+}
+_gemini_body_base = _GEMINI_BASE_BODY  # main() đổi sang cachedContent nếu tạo được
+
+# Regex patterns (compile 1 lần)
+_SUB_QUESTION_RE = re.compile(r'\(\d+\)')
+_ARTICLE_NUM_RE = re.compile(r'Điều\s*(\d+)')
+# Đánh dấu câu hỏi con: "Câu N" (lookahead, không nuốt số) hoặc "N." / "N)" / "(N)"
+_SUB_ANSWER_RE = re.compile(r'(?=Câu (\d+))|(\d+)[.)]')
+# Chỉ cần biết có match hay không → "\d" thay cho "\d+" là tương đương,
+# và tránh backtrack lại cả dãy chữ số ở mỗi vị trí bắt đầu
+_CALC_RE = re.compile(
+    r'\d\s*[×x\*]\s*\d'    # multiplication
+    r'|\d\s*[÷/]\s*\d'     # division
+    r'|=\s*\d'              # equals
+    r'|\d\s*triệu'          # money
+    r'|\d\s*%'              # percentage
+    r'|\d\s*tháng\s*lương'  # salary calculation
+)
+
 
 @dataclass
 class HardTestResult:
@@ -76,8 +121,7 @@ class HardTestResult:
 
 def count_sub_questions(question: str) -> int:
     """Đếm số câu hỏi con dựa trên pattern (1), (2), (3)..."""
-    patterns = re.findall(r'\(\d+\)', question)
-    return len(patterns) if patterns else 1
+    return len(_SUB_QUESTION_RE.findall(question)) or 1
 
 
 def count_answered_sub_questions(answer: str, count: int) -> int:
@@ -85,15 +129,23 @@ def count_answered_sub_questions(answer: str, count: int) -> int:
     if count == 1:
         return 1 if len(answer) > 50 else 0
     
-    answered = 0
-    for i in range(1, count + 1):
-        # Tìm pattern (1), (2)... hoặc "Câu 1", "1.", "1)"
-        patterns = [f"({i})", f"Câu {i}", f"{i}.", f"{i})"]
-        for p in patterns:
-            if p in answer:
-                answered += 1
-                break
-    return answered
+    # Quét answer 1 lần, gom các số đã xuất hiện. Giữ đúng ngữ nghĩa substring cũ:
+    # "Câu 12" chứa "Câu 1" (tiền tố), "12." chứa "2." (hậu tố)
+    found = set()
+    for m in _SUB_ANSWER_RE.finditer(answer):
+        if m.group(1):
+            digits = m.group(1)
+            found.update(digits[:k] for k in range(1, len(digits) + 1))
+        else:
+            digits = m.group(2)
+            found.update(digits[k:] for k in range(len(digits)))
+    return sum(1 for i in range(1, count + 1) if str(i) in found)
+
+
+@lru_cache(maxsize=512)
+def _coverage_re(article_num: str) -> re.Pattern:
+    """Pattern kiểm tra 1 điều luật, compile 1 lần cho mỗi số Điều"""
+    return re.compile(rf'Điều\s*{article_num}|{article_num}\s*(BLLĐ|BHXH|VL|ND)', re.IGNORECASE)
 
 
 def check_article_coverage(answer: str, sources: List[str], expected: List[str]) -> tuple:
@@ -103,11 +155,11 @@ def check_article_coverage(answer: str, sources: List[str], expected: List[str])
     
     for article in expected:
         # Extract article number
-        match = re.search(r'Điều\s*(\d+)', article)
+        match = _ARTICLE_NUM_RE.search(article)
         if match:
             article_num = match.group(1)
             # Check in answer or sources
-            if re.search(rf'Điều\s*{article_num}|{article_num}\s*(BLLĐ|BHXH|VL|ND)', text_to_check, re.IGNORECASE):
+            if _coverage_re(article_num).search(text_to_check):
                 hits += 1
     
     coverage = hits / len(expected) if expected else 0
@@ -116,97 +168,89 @@ def check_article_coverage(answer: str, sources: List[str], expected: List[str])
 
 def has_calculation(text: str) -> bool:
     """Kiểm tra câu trả lời có tính toán không"""
-    calc_patterns = [
-        r'\d+\s*[×x\*]\s*\d+',  # multiplication
-        r'\d+\s*[÷/]\s*\d+',   # division
-        r'=\s*\d+',             # equals
-        r'\d+\s*triệu',         # money
-        r'\d+\s*%',             # percentage
-        r'\d+\s*tháng\s*lương', # salary calculation
-    ]
-    return any(re.search(p, text) for p in calc_patterns)
-
-
-async def call_gemini_api(question: str) -> tuple:
+    return _CALC_RE.search(text) is not None
+
+
+async def call_gemini_api(client: httpx.AsyncClient, question: str) -> tuple:
     """Call Gemini API"""
-    start = asyncio.get_event_loop().time()
-    
     try:
-        async with httpx.AsyncClient(timeout=90.0) as client:
+        async with GEMINI_LIMITER:
+            start = perf_counter()
             resp = await client.post(
                 f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}",
-                json={
-                    "contents": [{"parts": [{"text": question}]}],
-                    "systemInstruction": {"parts": [{"text": GEMINI_SYSTEM_PROMPT}]},
-                    "generationConfig": {
-                        "temperature": 0.05,
-                        "maxOutputTokens": 4024
-                    }
-                }
+                json={"contents": [{"parts": [{"text": question}]}], **_gemini_body_base}
             )
-            data = resp.json()
-            
-            if "error" in data:
-                return "", 0, data['error'].get('message', 'Unknown error')
-            
-            if "candidates" in data and len(data["candidates"]) > 0:
-                text = data["candidates"][0]["content"]["parts"][0]["text"]
-                latency = (asyncio.get_event_loop().time() - start) * 1000
-                return text, latency, ""
-            
-            return "", 0, "No response"
-            
+        data = resp.json()
+        
+        if "error" in data:
+            return "", 0, data['error'].get('message', 'Unknown error')
+        
+        if "candidates" in data and len(data["candidates"]) > 0:
+            text = data["candidates"][0]["content"]["parts"][0]["text"]
+            latency = (perf_counter() - start) * 1000
+            return text, latency, ""
+        
+        return "", 0, "No response"
+        
     except Exception as e:
         return "", 0, str(e)
 
 
-async def call_rag_api(question: str) -> tuple:
+async def call_rag_api(client: httpx.AsyncClient, question: str) -> tuple:
     """Call RAG API"""
-    start = asyncio.get_event_loop().time()
+    start = perf_counter()
     
     try:
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            full_response = ""
-            sources = []
-            
-            async with client.stream(
-                "POST",
-                f"{RAG_API_URL}/chat",
-                json={"content": question}
-            ) as response:
-                async for line in response.aiter_lines():
-                    if not line.startswith("data:"):
+        answer_parts = []  # gom token vào list, join 1 lần sau stream (tránh nối chuỗi O(N²))
+        nodes = []  # giữ dict thô trong lúc stream, format source sau khi xong
+        
+        async with client.stream(
+            "POST",
+            f"{RAG_API_URL}/chat",
+            json={"content": question}
+        ) as response:
+            # Cắt dòng trên buffer bytes, msgspec decode thẳng bytes vào struct (không decode từng dòng)
+            buf = bytearray()
+            async for chunk in response.aiter_bytes():
+                buf.extend(chunk)
+                while (idx := buf.find(b"\n")) != -1:
+                    line = bytes(buf[:idx])
+                    del buf[:idx + 1]
+                    if not line.startswith(b"data:"):
                         continue
-                    json_str = line[5:].strip()
-                    if not json_str:
+                    payload = line[5:].strip()
+                    if not payload:
                         continue
                     try:
-                        data = json.loads(json_str)
-                        if "token" in data:
-                            full_response += data["token"]
-                        if "nodes" in data:
-                            for node in data["nodes"]:
-                                meta = node.get("metadata", {})
-                                sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
-                    except json.JSONDecodeError:
+                        event = decode_rag_event(payload)
+                    except DecodeError:
                         continue
-            
-            latency = (asyncio.get_event_loop().time() - start) * 1000
-            return full_response, sources, latency, ""
-            
+                    if event.token:
+                        answer_parts.append(event.token)
+                    if event.nodes:
+                        nodes.extend(event.nodes)
+        
+        latency = (perf_counter() - start) * 1000
+        full_response = "".join(answer_parts)
+        sources = []
+        for node in nodes:
+            meta = node.get("metadata", {})
+            sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
+        return full_response, sources, latency, ""
+        
     except Exception as e:
         return "", [], 0, str(e)
 
 
-async def evaluate_test_case(tc: Dict) -> HardTestResult:
+async def evaluate_test_case(client: httpx.AsyncClient, tc: Dict) -> HardTestResult:
     """Evaluate single test case with advanced metrics"""
     question = tc["question"]
     expected_articles = tc.get("expected_articles", [])
     sub_count = count_sub_questions(question)
     
     # Call both APIs
-    rag_answer, rag_sources, rag_latency, rag_error = await call_rag_api(question)
-    gemini_answer, gemini_latency, gemini_error = await call_gemini_api(question)
+    rag_answer, rag_sources, rag_latency, rag_error = await call_rag_api(client, question)
+    gemini_answer, gemini_latency, gemini_error = await call_gemini_api(client, question)
     
     # Calculate metrics
     rag_hits, rag_coverage = check_article_coverage(rag_answer, rag_sources, expected_articles)
@@ -253,28 +297,35 @@ def generate_report(results: List[HardTestResult]) -> Dict:
     if n == 0:
         return {}
     
-    # Basic metrics
-    avg_rag_latency = sum(r.rag_latency_ms for r in results) / n
-    avg_gemini_latency = sum(r.gemini_latency_ms for r in results) / n
-    avg_rag_words = sum(r.rag_word_count for r in results) / n
-    avg_gemini_words = sum(r.gemini_word_count for r in results) / n
-    
-    # Article coverage
-    avg_rag_coverage = sum(r.rag_article_coverage for r in results) / n
-    avg_gemini_coverage = sum(r.gemini_article_coverage for r in results) / n
+    # Gom mọi metric vào 1 mảng (1 lượt qua results), tính mean/sum theo cột
+    metrics = np.array([
+        (
+            r.rag_latency_ms, r.gemini_latency_ms,
+            r.rag_word_count, r.gemini_word_count,
+            r.rag_article_coverage, r.gemini_article_coverage,
+            r.rag_has_calculation, r.gemini_has_calculation,
+            bool(r.rag_error), bool(r.gemini_error),
+            r.sub_question_count, r.rag_sub_answered, r.gemini_sub_answered,
+        )
+        for r in results
+    ], dtype=np.float64)
+    
+    (
+        avg_rag_latency, avg_gemini_latency,
+        avg_rag_words, avg_gemini_words,
+        avg_rag_coverage, avg_gemini_coverage,
+        rag_calc_rate, gemini_calc_rate,
+        rag_error_rate, gemini_error_rate,
+    ) = metrics[:, :10].mean(axis=0).tolist()
+    
+    # Calculation presence / error rate (%)
+    rag_calc_rate *= 100
+    gemini_calc_rate *= 100
+    rag_error_rate *= 100
+    gemini_error_rate *= 100
     
     # Sub-question answering
-    total_sub = sum(r.sub_question_count for r in results)
-    rag_sub_answered = sum(r.rag_sub_answered for r in results)
-    gemini_sub_answered = sum(r.gemini_sub_answered for r in results)
-    
-    # Calculation presence
-    rag_calc_rate = sum(1 for r in results if r.rag_has_calculation) / n * 100
-    gemini_calc_rate = sum(1 for r in results if r.gemini_has_calculation) / n * 100
-    
-    # Error rate
-    rag_error_rate = sum(1 for r in results if r.rag_error) / n * 100
-    gemini_error_rate = sum(1 for r in results if r.gemini_error) / n * 100
+    total_sub, rag_sub_answered, gemini_sub_answered = map(int, metrics[:, 10:].sum(axis=0))
     
     return {
         "timestamp": datetime.now().isoformat(),
@@ -311,7 +362,8 @@ def generate_report(results: List[HardTestResult]) -> Dict:
                 "gemini_error_pct": round(gemini_error_rate, 1)
             }
         },
-        "results": [asdict(r) for r in results]
+        # orjson serialize dataclass trực tiếp, không cần asdict() từng result
+        "results": results
     }
 
 
@@ -361,17 +413,18 @@ def load_test_cases(file_name: str) -> List[Dict]:
     else:
         path = TEST_CASE_DIR / f"test_cases_chunk_{file_name}.json"
     
-    if path.exists():
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    
-    print(f"File not found: {path}")
-    return []
+    try:
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
+        print(f"File not found: {path}")
+        return []
 
 
 async def main():
+    global _gemini_body_base
     parser = argparse.ArgumentParser(description="Hard Test Cases Evaluation")
     parser.add_argument("--file", type=str, default="hard", help="Test case file name (without path)")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY, help="Number of test cases run concurrently")
     args = parser.parse_args()
     
     print("🔥 RAG vs Gemini - Hard Test Evaluation")
@@ -390,24 +443,48 @@ async def main():
     
     print(f"\n📋 Loaded {len(test_cases)} test cases from {args.file}")
     
-    results = []
-    for i, tc in enumerate(test_cases):
-        print(f"\n[{i+1}/{len(test_cases)}] {tc['id']}: {tc['question'][:60]}...")
-        result = await evaluate_test_case(tc)
-        results.append(result)
-        
-        print(f"   ⏱️  RAG={result.rag_latency_ms:.0f}ms | Gemini={result.gemini_latency_ms:.0f}ms")
-        print(f"   📚 Coverage: RAG={result.rag_article_coverage}% | Gemini={result.gemini_article_coverage}%")
-        print(f"   ❓ Sub-Q: RAG={result.rag_sub_answered}/{result.sub_question_count} | Gemini={result.gemini_sub_answered}/{result.sub_question_count}")
-        
-        await asyncio.sleep(2)
+    # Chạy song song, Semaphore giới hạn số request đồng thời tới RAG/Gemini
+    sem = asyncio.Semaphore(args.concurrency)
+    done = 0
+    
+    async def run_one(client: httpx.AsyncClient, i: int, tc: Dict) -> HardTestResult:
+        nonlocal done
+        async with sem:
+            result = await evaluate_test_case(client, tc)
+            
+            # Gom cả block vào 1 lần write, flush định kỳ (không flush từng dòng)
+            sys.stdout.write(
+                f"\n[{i+1}/{len(test_cases)}] {tc['id']}: {tc['question'][:60]}...\n"
+                f"   ⏱️  RAG={result.rag_latency_ms:.0f}ms | Gemini={result.gemini_latency_ms:.0f}ms\n"
+                f"   📚 Coverage: RAG={result.rag_article_coverage}% | Gemini={result.gemini_article_coverage}%\n"
+                f"   ❓ Sub-Q: RAG={result.rag_sub_answered}/{result.sub_question_count} | Gemini={result.gemini_sub_answered}/{result.sub_question_count}\n"
+            )
+            done += 1
+            if done % PROGRESS_FLUSH_EVERY == 0:
+                sys.stdout.flush()
+            return result
+    
+    # 1 client dùng chung → tái sử dụng kết nối (keep-alive, HTTP/2 nếu có h2)
+    async with httpx.AsyncClient(
+        timeout=90.0,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=32),
+    ) as client:
+        cache_name = await create_prompt_cache(client, GEMINI_API_KEY, GEMINI_MODEL, GEMINI_SYSTEM_PROMPT)
+        if cache_name:
+            _gemini_body_base = cached_body_base(_GEMINI_BASE_BODY, cache_name)
+        try:
+            results = await asyncio.gather(*(run_one(client, i, tc) for i, tc in enumerate(test_cases)))
+        finally:
+            if cache_name:
+                await delete_prompt_cache(client, GEMINI_API_KEY, cache_name)
+    sys.stdout.flush()
     
     report = generate_report(results)
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_path = RESULTS_DIR / f"hard_{args.file}_{timestamp}.json"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(report, f, ensure_ascii=False, indent=2)
+    output_path.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
     
     print(f"\n💾 Saved: {output_path}")
     print_summary(report)
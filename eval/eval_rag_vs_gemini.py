@@ -12,16 +12,31 @@ Usage:
     python eval_rag_vs_gemini_api.py --chunk 1
     python eval_rag_vs_gemini_api.py  # Run all
 """
-import json
+import orjson
 import httpx
+from aiolimiter import AsyncLimiter
 import asyncio
 import os
+import sys
+import re
 import argparse
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass, asdict
-from typing import List, Dict
+from time import perf_counter
+from dataclasses import dataclass
+from typing import List, Dict, BinaryIO, Optional
 from dotenv import load_dotenv
+from _gemini_prompt_cache import cached_body_base, create_prompt_cache, delete_prompt_cache
+from _llm_cache import cached_call
+from _semcache import SemanticCache
+from _sse import DecodeError, decode_rag_event
+
+try:
+    import h2  # noqa: F401  (HTTP/2 cho httpx)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+    print("⚠️ h2 not installed, using HTTP/1.1 (pip install 'httpx[http2]')")
 
 # Auto-resolve paths from script location
 SCRIPT_DIR = Path(__file__).parent.resolve()
@@ -35,6 +50,14 @@ load_dotenv(ENV_FILE)
 RAG_API_URL = os.getenv("RAG_API_URL", "http://localhost:8000")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_TEMPERATURE = 0.05
+# Chỉ cache response khi temperature đủ thấp (gần như deterministic)
+CACHE_MAX_TEMPERATURE = 0.05
+EVAL_CONCURRENCY = 8  # Số comparison chạy song song
+# Token bucket theo quota/phút của Gemini (free tier ~15 RPM), thay cho sleep cố định sau mỗi request
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_LIMITER = AsyncLimiter(GEMINI_RPM, 60)
+PROGRESS_FLUSH_EVERY = 10  # flush stdout mỗi N kết quả thay vì mỗi dòng print
 
 # System prompt for Gemini to match legal context
 GEMINI_SYSTEM_PROMPT = """You are a Vietnamese labor law expert assistant.
@@ -42,8 +65,23 @@ Answer questions about Vietnamese labor law accurately and concisely.
 Cite specific articles (Điều) and legal documents when possible.
 Respond in Vietnamese."""
 
+# Phần cố định của request body (system prompt + config), mỗi lần gọi chỉ ghép thêm câu hỏi.
+# System prompt luôn đứng đầu → Gemini implicit caching tái dùng prefix giữa các request
+_GEMINI_BASE_BODY = {
+    "systemInstruction": {"parts": [{"text": GEMINI_SYSTEM_PROMPT}]},
+    "generationConfig": {
+        "temperature": GEMINI_TEMPERATURE,
+        "maxOutputTokens": 4024
+    }
+}
+# main() thay bằng bản dùng cachedContent nếu tạo được prompt cache
+_gemini_body_base = _GEMINI_BASE_BODY
 
-@dataclass
+# Trích dẫn pháp lý (Điều, Khoản, ...) - compile 1 lần
+_CITATION_RE = re.compile(r'(Điều|điều|Khoản|khoản|Nghị định|BLLĐ|Luật)')
+
+
+@dataclass(slots=True, frozen=True)
 class ComparisonResult:
     test_id: str
     question: str
@@ -56,109 +94,175 @@ class ComparisonResult:
     gemini_word_count: int
     rag_has_citation: bool
     gemini_has_citation: bool
+    gemini_cached: bool = False  # Lấy từ cache (latency là latency gốc)
+    gemini_cache_source: str = ""  # "disk" (exact) | "semcache" (câu hỏi gần trùng)
 
 
-def load_test_cases_from_chunks(chunks: List[str]) -> List[Dict]:
-    all_cases = []
-    for chunk in chunks:
-        # Support both numeric and named chunks
-        if chunk.isdigit():
-            path = f"./test_cases_chunk{chunk}.json"
-        else:
-            path = f"./test_cases_chunk_{chunk}.json"
-        
-        if os.path.exists(path):
-            with open(path, 'r', encoding='utf-8') as f:
-                cases = json.load(f)
-                all_cases.extend(cases)
-                print(f"   Loaded chunk {chunk}: {len(cases)} cases")
-        else:
-            print(f"   Chunk {chunk} not found ({path})")
-    return all_cases
+@dataclass
+class SummaryStats:
+    """Tổng cộng dồn cho summary, không giữ lại từng ComparisonResult trong RAM"""
+    n: int = 0
+    rag_latency_ms: float = 0.0
+    gemini_latency_ms: float = 0.0
+    rag_words: int = 0
+    gemini_words: int = 0
+    rag_citations: int = 0
+    gemini_citations: int = 0
 
+    def add(self, r: ComparisonResult):
+        self.n += 1
+        self.rag_latency_ms += r.rag_latency_ms
+        self.gemini_latency_ms += r.gemini_latency_ms
+        self.rag_words += r.rag_word_count
+        self.gemini_words += r.gemini_word_count
+        self.rag_citations += r.rag_has_citation
+        self.gemini_citations += r.gemini_has_citation
 
-async def call_gemini_api(question: str) -> tuple:
-    """Call Gemini 2.5 Flash API directly"""
-    start = asyncio.get_event_loop().time()
+
+def _chunk_path(chunk: str) -> str:
+    # Support both numeric and named chunks
+    if chunk.isdigit():
+        return f"./test_cases_chunk{chunk}.json"
+    return f"./test_cases_chunk_{chunk}.json"
+
+
+def _load_chunk(path: str) -> Optional[List[Dict]]:
+    """Đọc 1 file test case (chạy trong thread), None nếu không tồn tại"""
+    # EAFP: open thẳng, không stat trước (1 syscall, không có race exists → open)
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+async def load_test_cases_from_chunk(chunk: str) -> List[Dict]:
+    # Đọc file trên thread pool, không chặn event loop
+    path = _chunk_path(chunk)
+    cases = await asyncio.to_thread(_load_chunk, path)
+    if cases is None:
+        print(f"   Chunk {chunk} not found ({path})")
+        return []
+    print(f"   Loaded chunk {chunk}: {len(cases)} cases")
+    return cases
+
+
+# Semantic cache cho câu hỏi paraphrase, tách theo model/prompt/temperature
+GEMINI_SEMCACHE = SemanticCache("gemini_sem", (GEMINI_MODEL, GEMINI_SYSTEM_PROMPT, GEMINI_TEMPERATURE))
+
+
+async def call_gemini_api(client: httpx.AsyncClient, question: str) -> tuple:
+    """Call Gemini (qua cache exact → semantic cache) → (answer, latency_ms, cache_source)"""
+    if GEMINI_TEMPERATURE > CACHE_MAX_TEMPERATURE:
+        return (*await _request_gemini(client, question), "")
+    
+    semantic_hit = False
     
+    async def fetch() -> tuple:
+        nonlocal semantic_hit
+        hit = await asyncio.to_thread(GEMINI_SEMCACHE.lookup, question)
+        if hit is not None:
+            semantic_hit = True
+            return tuple(hit)
+        value = await _request_gemini(client, question)
+        if value[1] > 0:
+            await asyncio.to_thread(GEMINI_SEMCACHE.add, question, value)
+        return value
+    
+    (text, latency), cached = await cached_call(
+        "gemini",
+        (GEMINI_MODEL, GEMINI_SYSTEM_PROMPT, question, GEMINI_TEMPERATURE),
+        fetch,
+        # latency 0 = lỗi; hit semantic là câu trả lời của câu hỏi khác → đều không ghi vào cache exact
+        should_cache=lambda value: value[1] > 0 and not semantic_hit,
+    )
+    return text, latency, "semcache" if semantic_hit else ("disk" if cached else "")
+
+
+async def _request_gemini(client: httpx.AsyncClient, question: str) -> tuple:
+    """Call Gemini 2.5 Flash API directly"""
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        # Chờ quota trước rồi mới bắt đầu tính latency
+        async with GEMINI_LIMITER:
+            start = perf_counter()
             resp = await client.post(
                 f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}",
-                json={
-                    "contents": [{"parts": [{"text": question}]}],
-                    "systemInstruction": {"parts": [{"text": GEMINI_SYSTEM_PROMPT}]},
-                    "generationConfig": {
-                        "temperature": 0.05,
-                        "maxOutputTokens": 4024
-                    }
-                }
+                json={"contents": [{"parts": [{"text": question}]}], **_gemini_body_base}
             )
-            data = resp.json()
-            
-            if "error" in data:
-                return f"[Gemini Error: {data['error']['message']}]", 0
-            
-            if "candidates" in data and len(data["candidates"]) > 0:
-                text = data["candidates"][0]["content"]["parts"][0]["text"]
-                latency = (asyncio.get_event_loop().time() - start) * 1000
-                return text, latency
-            
-            return "[No Gemini response]", 0
-            
+        data = resp.json()
+        
+        if "error" in data:
+            return f"[Gemini Error: {data['error']['message']}]", 0
+        
+        if "candidates" in data and len(data["candidates"]) > 0:
+            text = data["candidates"][0]["content"]["parts"][0]["text"]
+            latency = (perf_counter() - start) * 1000
+            return text, latency
+        
+        return "[No Gemini response]", 0
+        
     except Exception as e:
         return f"[Gemini Error: {str(e)}]", 0
 
 
-async def call_rag_api(question: str) -> tuple:
+async def call_rag_api(client: httpx.AsyncClient, question: str) -> tuple:
     """Call RAG API"""
-    start = asyncio.get_event_loop().time()
+    start = perf_counter()
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            full_response = ""
-            sources = []
-            
-            async with client.stream(
-                "POST",
-                f"{RAG_API_URL}/chat",
-                json={"content": question}
-            ) as response:
-                async for line in response.aiter_lines():
-                    if not line.startswith("data:"):
+        answer_parts = []
+        nodes = []  # giữ dict thô trong lúc stream, format source sau khi xong
+        
+        async with client.stream(
+            "POST",
+            f"{RAG_API_URL}/chat",
+            json={"content": question}
+        ) as response:
+            # Cắt dòng trên buffer bytes, msgspec decode thẳng bytes vào struct (không decode từng dòng)
+            buf = bytearray()
+            async for chunk in response.aiter_bytes():
+                buf.extend(chunk)
+                while (idx := buf.find(b"\n")) != -1:
+                    line = bytes(buf[:idx])
+                    del buf[:idx + 1]
+                    if not line.startswith(b"data:"):
                         continue
-                    json_str = line[5:].strip()
-                    if not json_str:
+                    payload = line[5:].strip()
+                    if not payload:
                         continue
                     try:
-                        data = json.loads(json_str)
-                        if "token" in data:
-                            full_response += data["token"]
-                        if "nodes" in data:
-                            for node in data["nodes"]:
-                                meta = node.get("metadata", {})
-                                sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
-                    except json.JSONDecodeError:
+                        event = decode_rag_event(payload)
+                    except DecodeError:
                         continue
-            
-            latency = (asyncio.get_event_loop().time() - start) * 1000
-            return full_response, sources, latency
-            
+                    if event.token:
+                        answer_parts.append(event.token)
+                    if event.nodes:
+                        nodes.extend(event.nodes)
+        
+        latency = (perf_counter() - start) * 1000
+        full_response = "".join(answer_parts)
+        sources = []
+        for node in nodes:
+            meta = node.get("metadata", {})
+            sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
+        return full_response, sources, latency
+        
     except Exception as e:
         return f"[RAG Error: {str(e)}]", [], 0
 
 
 def has_citation(text: str) -> bool:
-    import re
-    return bool(re.search(r'(Điều|điều|Khoản|khoản|Nghị định|BLLĐ|Luật)', text))
+    return _CITATION_RE.search(text) is not None
 
 
-async def run_comparison(test_case: Dict) -> ComparisonResult:
+async def run_comparison(client: httpx.AsyncClient, test_case: Dict) -> ComparisonResult:
     question = test_case["question"]
     
-    # Get both answers
-    rag_answer, sources, rag_latency = await call_rag_api(question)
-    gemini_answer, gemini_latency = await call_gemini_api(question)
+    # Get both answers (2 request độc lập → chạy song song)
+    (rag_answer, sources, rag_latency), (gemini_answer, gemini_latency, gemini_cache_source) = await asyncio.gather(
+        call_rag_api(client, question),
+        call_gemini_api(client, question),
+    )
     
     return ComparisonResult(
         test_id=test_case["id"],
@@ -171,37 +275,58 @@ async def run_comparison(test_case: Dict) -> ComparisonResult:
         rag_word_count=len(rag_answer.split()),
         gemini_word_count=len(gemini_answer.split()),
         rag_has_citation=has_citation(rag_answer),
-        gemini_has_citation=has_citation(gemini_answer)
+        gemini_has_citation=has_citation(gemini_answer),
+        gemini_cached=bool(gemini_cache_source),
+        gemini_cache_source=gemini_cache_source,
     )
 
 
-async def run_evaluation(test_cases: List[Dict]) -> List[ComparisonResult]:
-    results = []
+async def run_evaluation(
+    client: httpx.AsyncClient, test_cases: List[Dict], results_file: BinaryIO,
+    stats: SummaryStats, concurrency: int = EVAL_CONCURRENCY,
+) -> SummaryStats:
+    """Ghi mỗi result thành 1 dòng JSONL ngay khi xong, chỉ cộng dồn vào stats"""
     total = len(test_cases)
+    # Semaphore giới hạn số comparison chạy đồng thời (rate limit của API)
+    sem = asyncio.Semaphore(concurrency)
     
-    for i, tc in enumerate(test_cases):
-        print(f"\n[{i+1}/{total}] {tc['id']}: {tc['question'][:50]}...")
-        result = await run_comparison(tc)
-        results.append(result)
-        
-        print(f"  Time: RAG={result.rag_latency_ms:.0f}ms | Gemini={result.gemini_latency_ms:.0f}ms")
-        print(f"  Words: RAG={result.rag_word_count} | Gemini={result.gemini_word_count}")
-        print(f"  Citations: RAG={'Yes' if result.rag_has_citation else 'No'} | Gemini={'Yes' if result.gemini_has_citation else 'No'}")
+    async def bounded(i: int, tc: Dict) -> tuple:
+        async with sem:
+            result = await run_comparison(client, tc)
+            return i, result
+    
+    tasks = [asyncio.create_task(bounded(i, tc)) for i, tc in enumerate(test_cases)]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        i, result = await future
+        # orjson serialize dataclass trực tiếp, không cần asdict()
+        results_file.write(orjson.dumps(result) + b"\n")
+        results_file.flush()
+        stats.add(result)
+        tc = test_cases[i]
         
-        await asyncio.sleep(2)  # Rate limit
+        # Gom cả block vào 1 lần write, flush định kỳ (không flush từng dòng)
+        sys.stdout.write(
+            f"\n[{done}/{total}] {tc['id']}: {tc['question'][:50]}...\n"
+            f"  Time: RAG={result.rag_latency_ms:.0f}ms | Gemini={result.gemini_latency_ms:.0f}ms\n"
+            f"  Words: RAG={result.rag_word_count} | Gemini={result.gemini_word_count}\n"
+            f"  Citations: RAG={'Yes' if result.rag_has_citation else 'No'} | Gemini={'Yes' if result.gemini_has_citation else 'No'}\n"
+        )
+        if done % PROGRESS_FLUSH_EVERY == 0:
+            sys.stdout.flush()
     
-    return results
+    sys.stdout.flush()
+    return stats
 
 
-def generate_report(results: List[ComparisonResult]) -> Dict:
-    n = len(results)
+def generate_report(stats: SummaryStats, results_path: str) -> Dict:
+    n = stats.n
     
-    avg_rag_latency = sum(r.rag_latency_ms for r in results) / n if n else 0
-    avg_gemini_latency = sum(r.gemini_latency_ms for r in results) / n if n else 0
-    avg_rag_words = sum(r.rag_word_count for r in results) / n if n else 0
-    avg_gemini_words = sum(r.gemini_word_count for r in results) / n if n else 0
-    rag_citation_rate = sum(1 for r in results if r.rag_has_citation) / n if n else 0
-    gemini_citation_rate = sum(1 for r in results if r.gemini_has_citation) / n if n else 0
+    avg_rag_latency = stats.rag_latency_ms / n if n else 0
+    avg_gemini_latency = stats.gemini_latency_ms / n if n else 0
+    avg_rag_words = stats.rag_words / n if n else 0
+    avg_gemini_words = stats.gemini_words / n if n else 0
+    rag_citation_rate = stats.rag_citations / n if n else 0
+    gemini_citation_rate = stats.gemini_citations / n if n else 0
     
     return {
         "timestamp": datetime.now().isoformat(),
@@ -215,7 +340,7 @@ def generate_report(results: List[ComparisonResult]) -> Dict:
             "rag_citation_rate": round(rag_citation_rate * 100, 1),
             "gemini_citation_rate": round(gemini_citation_rate * 100, 1)
         },
-        "results": [asdict(r) for r in results]
+        "results_file": str(results_path)
     }
 
 
@@ -237,8 +362,10 @@ def print_summary(report: Dict):
 
 
 async def main():
+    global _gemini_body_base
     parser = argparse.ArgumentParser(description="RAG vs Gemini API Eval")
     parser.add_argument("--chunk", type=str, nargs="+", help="Chunk names (1-6 or 'hard')")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY, help="Number of comparisons run concurrently")
     args = parser.parse_args()
     
     print("RAG vs Gemini 2.5 Flash Evaluation")
@@ -254,23 +381,49 @@ async def main():
     
     chunks = args.chunk if args.chunk else ["1", "2", "3", "4", "5", "6"]
     print(f"\nLoading chunks: {chunks}")
-    test_cases = load_test_cases_from_chunks(chunks)
     
-    if not test_cases:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    results_path = f"{RESULTS_DIR}/rag_vs_gemini_api_{timestamp}.jsonl"
+    output_path = f"{RESULTS_DIR}/rag_vs_gemini_api_{timestamp}.json"
+    
+    stats = SummaryStats()
+    # 1 client dùng chung cho mọi request → giữ kết nối (keep-alive, HTTP/2 nếu có h2)
+    async with httpx.AsyncClient(
+        timeout=60.0,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=32),
+    ) as client:
+        # System prompt upload 1 lần lên cachedContents, request chỉ gửi tên cache
+        cache_name = await create_prompt_cache(client, GEMINI_API_KEY, GEMINI_MODEL, GEMINI_SYSTEM_PROMPT)
+        if cache_name:
+            _gemini_body_base = cached_body_base(_GEMINI_BASE_BODY, cache_name)
+        try:
+            # Append từng result vào JSONL → không mất kết quả nếu bị ngắt giữa chừng
+            with open(results_path, 'wb') as results_file:
+                # Từng chunk: load → eval → ghi JSONL → bỏ, RAM chỉ giữ test case của 1 chunk
+                for chunk in chunks:
+                    test_cases = await load_test_cases_from_chunk(chunk)
+                    if not test_cases:
+                        continue
+                    print(f"\nRunning {len(test_cases)} comparisons...")
+                    await run_evaluation(client, test_cases, results_file, stats, args.concurrency)
+        finally:
+            if cache_name:
+                await delete_prompt_cache(client, GEMINI_API_KEY, cache_name)
+    GEMINI_SEMCACHE.save()
+    
+    if not stats.n:
         print("No test cases!")
+        os.remove(results_path)
         return
     
-    print(f"\nRunning {len(test_cases)} comparisons...")
-    results = await run_evaluation(test_cases)
-    
-    report = generate_report(results)
+    report = generate_report(stats, results_path)
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_path = f"{RESULTS_DIR}/rag_vs_gemini_api_{timestamp}.json"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
     
     print(f"\nSaved: {output_path}")
+    print(f"   Results: {results_path}")
     print_summary(report)
 
 
@@ -1,14 +1,28 @@
 
-import json
+import orjson
 import httpx
+from aiolimiter import AsyncLimiter
 import asyncio
 import os
+import sys
+import re
 import argparse
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass, asdict
-from typing import List, Dict, Optional
+from time import perf_counter
+from dataclasses import dataclass
+from typing import List, Dict, BinaryIO, Optional
 from dotenv import load_dotenv
+from _llm_cache import cached_call
+from _semcache import SemanticCache
+from _sse import DecodeError, decode_rag_event
+
+try:
+    import h2  # noqa: F401  (HTTP/2 cho httpx)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+    print("⚠️ h2 not installed, using HTTP/1.1 (pip install 'httpx[http2]')")
 
 # Auto-resolve paths from script location
 SCRIPT_DIR = Path(__file__).parent.resolve()
@@ -21,9 +35,20 @@ load_dotenv(ENV_FILE)
 # ===== CONFIG =====
 RAG_API_URL = os.getenv("RAG_API_URL", "http://localhost:8000")
 SERP_API_KEY = os.getenv("SERP_API_KEY")
+EVAL_CONCURRENCY = 8  # Số comparison chạy song song
+# Token bucket theo quota/phút của SerpAPI, thay cho sleep cố định sau mỗi request
+SERPAPI_RPM = int(os.getenv("SERPAPI_RPM", "100"))
+SERPAPI_LIMITER = AsyncLimiter(SERPAPI_RPM, 60)
+PROGRESS_FLUSH_EVERY = 10  # flush stdout mỗi N kết quả thay vì mỗi dòng print
+GOOGLE_QUERY_SUFFIX = "luật lao động Việt Nam"
+# Kết quả lỗi từ search_google → không cache
+GOOGLE_ERROR_PREFIXES = ("[ERROR", "[No content found", "[Google Error")
 
+# Trích dẫn pháp lý (Điều, Khoản, ...) - compile 1 lần
+_CITATION_RE = re.compile(r'(Điều|điều|Khoản|khoản|Nghị định|BLLĐ|Luật)')
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class ComparisonResult:
     test_id: str
     question: str
@@ -40,23 +65,53 @@ class ComparisonResult:
     google_char_count: int
     rag_has_citation: bool  # Has "Điều" reference
     google_has_citation: bool
+    google_cached: bool = False  # Lấy từ cache (latency là latency gốc)
+    google_cache_source: str = ""  # "disk" (exact) | "semcache" (câu hỏi gần trùng)
 
 
-def load_test_cases_from_chunks(chunks: List[int]) -> List[Dict]:
-    all_cases = []
-    for chunk_num in chunks:
-        path = TEST_CASE_DIR / f"test_cases_chunk{chunk_num}.json"
-        if path.exists():
-            with open(path, 'r', encoding='utf-8') as f:
-                cases = json.load(f)
-                all_cases.extend(cases)
-                print(f"   ✅ Loaded chunk {chunk_num}: {len(cases)} cases")
-        else:
-            print(f"   ⚠️ Chunk {chunk_num} not found: {path}")
-    return all_cases
+@dataclass
+class SummaryStats:
+    """Tổng cộng dồn cho summary, không giữ lại từng ComparisonResult trong RAM"""
+    n: int = 0
+    rag_latency_ms: float = 0.0
+    google_latency_ms: float = 0.0
+    rag_words: int = 0
+    google_words: int = 0
+    rag_citations: int = 0
+    google_citations: int = 0
+
+    def add(self, r: ComparisonResult):
+        self.n += 1
+        self.rag_latency_ms += r.rag_latency_ms
+        self.google_latency_ms += r.google_latency_ms
+        self.rag_words += r.rag_word_count
+        self.google_words += r.google_word_count
+        self.rag_citations += r.rag_has_citation
+        self.google_citations += r.google_has_citation
+
+
+def _load_chunk(path: Path) -> Optional[List[Dict]]:
+    """Đọc 1 file test case (chạy trong thread), None nếu không tồn tại"""
+    # EAFP: open thẳng, không stat trước (1 syscall, không có race exists → open)
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
 
+async def load_test_cases_from_chunk(chunk_num: int) -> List[Dict]:
+    # Đọc file trên thread pool, không chặn event loop
+    path = TEST_CASE_DIR / f"test_cases_chunk{chunk_num}.json"
+    cases = await asyncio.to_thread(_load_chunk, path)
+    if cases is None:
+        print(f"   ⚠️ Chunk {chunk_num} not found: {path}")
+        return []
+    print(f"   ✅ Loaded chunk {chunk_num}: {len(cases)} cases")
+    return cases
 
-async def search_google(query: str) -> str:
+
+async def search_google(client: httpx.AsyncClient, query: str) -> str:
     """
     Search Google using SerpAPI - get AI Overview FULL content
     """
@@ -64,127 +119,160 @@ async def search_google(query: str) -> str:
         return "[ERROR: Set SERP_API_KEY in .env file]"
     
     try:
-        search_query = f"{query} luật lao động Việt Nam"
+        search_query = f"{query} {GOOGLE_QUERY_SUFFIX}"
+        
+        resp = await client.get(
+            "https://serpapi.com/search",
+            timeout=30.0,
+            params={
+                "q": search_query,
+                "api_key": SERP_API_KEY,
+                "hl": "vi",
+                "gl": "vn",
+                "google_domain": "google.com.vn"
+            }
+        )
+        data = resp.json()
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.get(
-                "https://serpapi.com/search",
-                params={
-                    "q": search_query,
-                    "api_key": SERP_API_KEY,
-                    "hl": "vi",
-                    "gl": "vn",
-                    "google_domain": "google.com.vn"
-                }
-            )
-            data = resp.json()
-            
-            result_parts = []
-            
-            # 1. AI Overview (Gemini/AI answer) - Get FULL
-            if "ai_overview" in data:
-                ai = data["ai_overview"]
-                if isinstance(ai, dict):
-                    # Try different keys
-                    for key in ["text", "snippet", "answer", "text_blocks"]:
-                        if key in ai:
-                            content = ai[key]
-                            if isinstance(content, list):
-                                result_parts.append("[AI Overview]\n" + "\n".join(str(x) for x in content))
-                            else:
-                                result_parts.append(f"[AI Overview]\n{content}")
-                            break
-                elif isinstance(ai, str):
-                    result_parts.append(f"[AI Overview]\n{ai}")
-            
-            # 2. Answer Box
-            if "answer_box" in data:
-                box = data["answer_box"]
-                for key in ["answer", "snippet", "result", "contents"]:
-                    if key in box:
-                        result_parts.append(f"[Answer Box]\n{box[key]}")
+        result_parts = []
+        
+        # 1. AI Overview (Gemini/AI answer) - Get FULL
+        if "ai_overview" in data:
+            ai = data["ai_overview"]
+            if isinstance(ai, dict):
+                # Try different keys
+                for key in ["text", "snippet", "answer", "text_blocks"]:
+                    if key in ai:
+                        content = ai[key]
+                        if isinstance(content, list):
+                            result_parts.append("[AI Overview]\n" + "\n".join(str(x) for x in content))
+                        else:
+                            result_parts.append(f"[AI Overview]\n{content}")
                         break
-            
-            # 3. Organic Results (top 3)
-            if "organic_results" in data:
-                for i, result in enumerate(data["organic_results"][:3]):
-                    snippet = result.get("snippet", "")
-                    title = result.get("title", "")
-                    link = result.get("link", "")
-                    if snippet:
-                        result_parts.append(f"[Result {i+1}] {title}\n{snippet}\n{link}")
-            
-            # Debug: print what keys we got
-            if not result_parts:
-                print(f"  📋 SerpAPI keys: {list(data.keys())}")
-                return f"[No content found. Keys: {list(data.keys())}]"
-            
-            return "\n\n".join(result_parts)
-            
+            elif isinstance(ai, str):
+                result_parts.append(f"[AI Overview]\n{ai}")
+        
+        # 2. Answer Box
+        if "answer_box" in data:
+            box = data["answer_box"]
+            for key in ["answer", "snippet", "result", "contents"]:
+                if key in box:
+                    result_parts.append(f"[Answer Box]\n{box[key]}")
+                    break
+        
+        # 3. Organic Results (top 3)
+        if "organic_results" in data:
+            for i, result in enumerate(data["organic_results"][:3]):
+                snippet = result.get("snippet", "")
+                title = result.get("title", "")
+                link = result.get("link", "")
+                if snippet:
+                    result_parts.append(f"[Result {i+1}] {title}\n{snippet}\n{link}")
+        
+        # Debug: print what keys we got
+        if not result_parts:
+            print(f"  📋 SerpAPI keys: {list(data.keys())}")
+            return f"[No content found. Keys: {list(data.keys())}]"
+        
+        return "\n\n".join(result_parts)
+        
     except Exception as e:
         return f"[Google Error: {str(e)}]"
 
 
-async def call_rag_api(question: str) -> tuple:
+async def call_rag_api(client: httpx.AsyncClient, question: str) -> tuple:
     """
     Call RAG API - get FULL answer
     """
-    start_time = asyncio.get_event_loop().time()
+    start_time = perf_counter()
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            full_response = ""
-            sources = []
-            
-            async with client.stream(
-                "POST",
-                f"{RAG_API_URL}/chat",
-                json={"content": question}
-            ) as response:
-                async for line in response.aiter_lines():
-                    if not line.startswith("data:"):
+        answer_parts = []
+        nodes = []  # giữ dict thô trong lúc stream, format source sau khi xong
+        
+        async with client.stream(
+            "POST",
+            f"{RAG_API_URL}/chat",
+            json={"content": question}
+        ) as response:
+            # Cắt dòng trên buffer bytes, msgspec decode thẳng bytes vào struct (không decode từng dòng)
+            buf = bytearray()
+            async for chunk in response.aiter_bytes():
+                buf.extend(chunk)
+                while (idx := buf.find(b"\n")) != -1:
+                    line = bytes(buf[:idx])
+                    del buf[:idx + 1]
+                    if not line.startswith(b"data:"):
                         continue
-                    json_str = line[5:].strip()
-                    if not json_str:
+                    payload = line[5:].strip()
+                    if not payload:
                         continue
                     try:
-                        data = json.loads(json_str)
-                        if "token" in data:
-                            full_response += data["token"]
-                        if "nodes" in data:
-                            for node in data["nodes"]:
-                                meta = node.get("metadata", {})
-                                sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
-                    except json.JSONDecodeError:
+                        event = decode_rag_event(payload)
+                    except DecodeError:
                         continue
-            
-            latency_ms = (asyncio.get_event_loop().time() - start_time) * 1000
-            return full_response, sources, latency_ms
-            
+                    if event.token:
+                        answer_parts.append(event.token)
+                    if event.nodes:
+                        nodes.extend(event.nodes)
+        
+        latency_ms = (perf_counter() - start_time) * 1000
+        full_response = "".join(answer_parts)
+        sources = []
+        for node in nodes:
+            meta = node.get("metadata", {})
+            sources.append(f"{meta.get('article_id', '')} {meta.get('short_name', '')}")
+        return full_response, sources, latency_ms
+        
     except Exception as e:
         return f"[RAG Error: {str(e)}]", [], 0
 
 
-async def search_google_with_timing(query: str) -> tuple:
-    """Search Google and return (answer, latency_ms)"""
-    start = asyncio.get_event_loop().time()
-    answer = await search_google(query)
-    latency = (asyncio.get_event_loop().time() - start) * 1000
-    return answer, latency
+# Semantic cache cho câu hỏi paraphrase (cùng query suffix / locale)
+GOOGLE_SEMCACHE = SemanticCache("serpapi_sem", (GOOGLE_QUERY_SUFFIX, "vi", "vn"))
+
+
+async def search_google_with_timing(client: httpx.AsyncClient, query: str) -> tuple:
+    """Search Google (qua cache exact → semantic cache) and return (answer, latency_ms, cache_source)"""
+    semantic_hit = False
+    
+    async def fetch() -> tuple:
+        nonlocal semantic_hit
+        hit = await asyncio.to_thread(GOOGLE_SEMCACHE.lookup, query)
+        if hit is not None:
+            semantic_hit = True
+            return tuple(hit)
+        async with SERPAPI_LIMITER:
+            start = perf_counter()
+            answer = await search_google(client, query)
+            latency = (perf_counter() - start) * 1000
+        if not answer.startswith(GOOGLE_ERROR_PREFIXES):
+            await asyncio.to_thread(GOOGLE_SEMCACHE.add, query, (answer, latency))
+        return answer, latency
+    
+    (answer, latency), cached = await cached_call(
+        "serpapi",
+        (f"{query} {GOOGLE_QUERY_SUFFIX}", "vi", "vn"),
+        fetch,
+        # Hit semantic là kết quả của query khác → không ghi vào cache exact dưới key của query này
+        should_cache=lambda value: not semantic_hit and not value[0].startswith(GOOGLE_ERROR_PREFIXES),
+    )
+    return answer, latency, "semcache" if semantic_hit else ("disk" if cached else "")
 
 
 def has_citation(text: str) -> bool:
     """Check if text contains legal citation (Điều, Khoản, etc.)"""
-    import re
-    return bool(re.search(r'(Điều|điều|Khoản|khoản|Nghị định|BLLĐ|Luật)', text))
+    return _CITATION_RE.search(text) is not None
 
 
-async def run_comparison(test_case: Dict) -> ComparisonResult:
+async def run_comparison(client: httpx.AsyncClient, test_case: Dict) -> ComparisonResult:
     question = test_case["question"]
     
-    # Get both answers with timing
-    rag_answer, sources, rag_latency = await call_rag_api(question)
-    google_answer, google_latency = await search_google_with_timing(question)
+    # Get both answers with timing (2 request độc lập → chạy song song)
+    (rag_answer, sources, rag_latency), (google_answer, google_latency, google_cache_source) = await asyncio.gather(
+        call_rag_api(client, question),
+        search_google_with_timing(client, question),
+    )
     
     return ComparisonResult(
         test_id=test_case["id"],
@@ -201,39 +289,59 @@ async def run_comparison(test_case: Dict) -> ComparisonResult:
         rag_char_count=len(rag_answer),
         google_char_count=len(google_answer),
         rag_has_citation=has_citation(rag_answer),
-        google_has_citation=has_citation(google_answer)
+        google_has_citation=has_citation(google_answer),
+        google_cached=bool(google_cache_source),
+        google_cache_source=google_cache_source,
     )
 
 
-async def run_evaluation(test_cases: List[Dict]) -> List[ComparisonResult]:
-    results = []
+async def run_evaluation(
+    client: httpx.AsyncClient, test_cases: List[Dict], results_file: BinaryIO,
+    stats: SummaryStats, concurrency: int = EVAL_CONCURRENCY,
+) -> SummaryStats:
+    """Ghi mỗi result thành 1 dòng JSONL ngay khi xong, chỉ cộng dồn vào stats"""
     total = len(test_cases)
+    # Semaphore giới hạn số comparison chạy đồng thời (rate limit của API)
+    sem = asyncio.Semaphore(concurrency)
     
-    for i, tc in enumerate(test_cases):
-        print(f"\n[{i+1}/{total}] {tc['id']}: {tc['question'][:50]}...")
-        result = await run_comparison(tc)
-        results.append(result)
-        
-        # Preview with metrics
-        print(f"  RAG: {result.rag_latency_ms:.0f}ms | Google: {result.google_latency_ms:.0f}ms")
-        print(f"  RAG: {result.rag_word_count} words | Google: {result.google_word_count} words")
-        print(f"  Citations: RAG={'✅' if result.rag_has_citation else '❌'} | Google={'✅' if result.google_has_citation else '❌'}")
+    async def bounded(i: int, tc: Dict) -> tuple:
+        async with sem:
+            result = await run_comparison(client, tc)
+            return i, result
+    
+    tasks = [asyncio.create_task(bounded(i, tc)) for i, tc in enumerate(test_cases)]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        i, result = await future
+        # orjson serialize dataclass trực tiếp, không cần asdict()
+        results_file.write(orjson.dumps(result) + b"\n")
+        results_file.flush()
+        stats.add(result)
+        tc = test_cases[i]
         
-        await asyncio.sleep(1)
+        sys.stdout.write(
+            f"\n[{done}/{total}] {tc['id']}: {tc['question'][:50]}...\n"
+            # Preview with metrics
+            f"  RAG: {result.rag_latency_ms:.0f}ms | Google: {result.google_latency_ms:.0f}ms\n"
+            f"  RAG: {result.rag_word_count} words | Google: {result.google_word_count} words\n"
+            f"  Citations: RAG={'✅' if result.rag_has_citation else '❌'} | Google={'✅' if result.google_has_citation else '❌'}\n"
+        )
+        if done % PROGRESS_FLUSH_EVERY == 0:
+            sys.stdout.flush()
     
-    return results
+    sys.stdout.flush()
+    return stats
 
 
-def generate_report(results: List[ComparisonResult]) -> Dict:
-    n = len(results)
+def generate_report(stats: SummaryStats, results_path: str) -> Dict:
+    n = stats.n
     
     # Calculate averages
-    avg_rag_latency = sum(r.rag_latency_ms for r in results) / n if n else 0
-    avg_google_latency = sum(r.google_latency_ms for r in results) / n if n else 0
-    avg_rag_words = sum(r.rag_word_count for r in results) / n if n else 0
-    avg_google_words = sum(r.google_word_count for r in results) / n if n else 0
-    rag_citation_rate = sum(1 for r in results if r.rag_has_citation) / n if n else 0
-    google_citation_rate = sum(1 for r in results if r.google_has_citation) / n if n else 0
+    avg_rag_latency = stats.rag_latency_ms / n if n else 0
+    avg_google_latency = stats.google_latency_ms / n if n else 0
+    avg_rag_words = stats.rag_words / n if n else 0
+    avg_google_words = stats.google_words / n if n else 0
+    rag_citation_rate = stats.rag_citations / n if n else 0
+    google_citation_rate = stats.google_citations / n if n else 0
     
     return {
         "timestamp": datetime.now().isoformat(),
@@ -246,7 +354,7 @@ def generate_report(results: List[ComparisonResult]) -> Dict:
             "rag_citation_rate": round(rag_citation_rate * 100, 1),
             "google_citation_rate": round(google_citation_rate * 100, 1)
         },
-        "results": [asdict(r) for r in results]
+        "results_file": str(results_path)
     }
 
 
@@ -270,6 +378,7 @@ def print_summary(report: Dict):
 async def main():
     parser = argparse.ArgumentParser(description="RAG vs Google Comparison")
     parser.add_argument("--chunk", type=int, nargs="+", help="Chunk numbers (1-6)")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY, help="Number of comparisons run concurrently")
     args = parser.parse_args()
     
     print("🚀 RAG vs Google Comparison")
@@ -284,22 +393,41 @@ async def main():
     
     chunks = args.chunk if args.chunk else [1, 2, 3, 4, 5, 6]
     print(f"\n Loading chunks: {chunks}")
-    test_cases = load_test_cases_from_chunks(chunks)
     
-    if not test_cases:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    results_path = RESULTS_DIR / f"comparison_{timestamp}.jsonl"
+    output_path = RESULTS_DIR / f"comparison_{timestamp}.json"
+    
+    stats = SummaryStats()
+    # 1 client dùng chung cho mọi request → giữ kết nối (keep-alive, HTTP/2 nếu có h2)
+    async with httpx.AsyncClient(
+        timeout=60.0,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=32),
+    ) as client:
+        # Append từng result vào JSONL → không mất kết quả nếu bị ngắt giữa chừng
+        with open(results_path, 'wb') as results_file:
+            # Từng chunk: load → eval → ghi JSONL → bỏ, RAM chỉ giữ test case của 1 chunk
+            for chunk in chunks:
+                test_cases = await load_test_cases_from_chunk(chunk)
+                if not test_cases:
+                    continue
+                print(f"\n🔄 Running {len(test_cases)} comparisons...")
+                await run_evaluation(client, test_cases, results_file, stats, args.concurrency)
+    GOOGLE_SEMCACHE.save()
+    
+    if not stats.n:
         print("❌ No test cases!")
+        os.remove(results_path)
         return
     
-    print(f"\n🔄 Running {len(test_cases)} comparisons...")
-    results = await run_evaluation(test_cases)
-    report = generate_report(results)
+    report = generate_report(stats, results_path)
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_path = RESULTS_DIR / f"comparison_{timestamp}.json"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
     
     print(f"\n💾 Saved: {output_path}")
+    print(f"   Results: {results_path}")
     print_summary(report)
 
 
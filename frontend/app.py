@@ -1,8 +1,9 @@
 
 import os
-import json
+import msgspec
 import chainlit as cl
 import httpx
+from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -24,9 +25,30 @@ load_dotenv()
 #         })
 #     return results
 
+try:
+    import h2  # noqa: F401  (HTTP/2 cho httpx: nhiều SSE stream dùng chung 1 kết nối)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+    print("⚠️ h2 not installed, using HTTP/1.1 (pip install 'httpx[http2]')")
+
+# 1 frame SSE từ /chat: decode thẳng vào struct (C parser, không tạo dict cho mỗi frame)
+class SseEvent(msgspec.Struct, kw_only=True):
+    token: Optional[str] = None
+    intent: Optional[str] = None
+    nodes: Optional[List[Dict[str, Any]]] = None
+    nodes_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+_SSE_DECODER = msgspec.json.Decoder(SseEvent)
+
 # Configuration
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
+# 1 AsyncClient cho cả app: connection pool được tái sử dụng qua các lượt chat
+http_client = httpx.AsyncClient(timeout=60.0, http2=HTTP2_ENABLED)
+
 @cl.on_chat_start
 async def start():
     """Initialize chat session with Welcome Message"""
@@ -56,126 +78,140 @@ async def main(message: cl.Message):
     # final_answer = ""
     payload = {"content": message.content}
     
-    # 2. Call Backend with httpx
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            async with client.stream("POST", f"{BACKEND_URL}/chat", json=payload) as response:
+    # 2. Call Backend with httpx (client dùng chung, giữ kết nối giữa các tin nhắn)
+    try:
+        async with http_client.stream("POST", f"{BACKEND_URL}/chat", json=payload) as response:
+            
+            if response.status_code != 200:
+                err_text = await response.aread()
+                msg.content = f"**Lỗi Server ({response.status_code}):**\n{err_text.decode()}"
+                await msg.update()
+                return
+
+            # Local storage for accumulation
+            source_nodes = []
+            nodes_id = None
+            intent = None
+
+            # 3. Process SSE Stream
+            # Cắt dòng trên buffer bytes, msgspec decode thẳng bytes vào struct (không decode từng dòng)
+            buf = bytearray()
+            async for chunk in response.aiter_bytes():
+                buf.extend(chunk)
+                while (pos := buf.find(b"\n")) != -1:
+                    line = bytes(buf[:pos]).strip()
+                    del buf[:pos + 1]
                 
-                if response.status_code != 200:
-                    err_text = await response.aread()
-                    msg.content = f"**Lỗi Server ({response.status_code}):**\n{err_text.decode()}"
-                    await msg.update()
-                    return
-
-                # Local storage for accumulation
-                source_nodes = []
-                intent = None
-
-                # 3. Process SSE Stream
-                async for line in response.aiter_lines():
-                    line = line.strip()
-                    
                     # Filter for 'data:' lines
-                    if not line.startswith("data:"):
+                    if not line.startswith(b"data:"):
                         continue
-                    
-                    json_str = line[5:].strip()
-                    if not json_str or json_str == "[DONE]":
+                
+                    payload = line[5:].strip()
+                    if not payload or payload == b"[DONE]":
                         continue
-                        
+                    
                     try:
-                        data = json.loads(json_str)
-                        
-                        # Handle Errors
-                        if "error" in data:
-                            msg.content += f"\n\n**Lỗi:** {data['error']}"
-                            await msg.update()
-                            continue
-
-                        # A. Stream Text Token
-                        if "token" in data:
-                            # token = data["token"]
-                            # final_answer += token
-                            await msg.stream_token(data["token"])
-                        
-                        # B. Capture Metadata
-                        if "intent" in data:
-                            intent = data["intent"]
-                        if "nodes" in data:
-                            source_nodes = data["nodes"]
-                            
-                    except json.JSONDecodeError:
+                        event = _SSE_DECODER.decode(payload)
+                    except msgspec.DecodeError:
                         continue
+                    
+                    # Handle Errors
+                    if event.error is not None:
+                        msg.content += f"\n\n**Lỗi:** {event.error}"
+                        await msg.update()
+                        continue
+
+                    # A. Stream Text Token
+                    if event.token:
+                        # token = event.token
+                        # final_answer += token
+                        await msg.stream_token(event.token)
+                    
+                    # B. Capture Metadata
+                    if event.intent is not None:
+                        intent = event.intent
+                    if event.nodes:
+                        source_nodes = event.nodes
+                        nodes_id = event.nodes_id
+            
+            # Stream chỉ chứa preview → lấy nội dung đầy đủ cho side panel (lỗi thì giữ preview)
+            if nodes_id:
+                try:
+                    nodes_resp = await http_client.get(f"{BACKEND_URL}/nodes/{nodes_id}")
+                    if nodes_resp.status_code == 200:
+                        source_nodes = nodes_resp.json()
+                except httpx.HTTPError:
+                    pass
+            
+            # 4. Display Sources (After stream finishes)
+            if source_nodes:
+                elements = []
+                ref_names = []
                 
-                # 4. Display Sources (After stream finishes)
-                if source_nodes:
-                    elements = []
-                    ref_names = []
+                for idx, node in enumerate(source_nodes):
+                    # Extract metadata (new schema)
+                    meta = node.get("metadata", {})
+                    score = node.get("score", 0)
                     
-                    for idx, node in enumerate(source_nodes):
-                        # Extract metadata (new schema)
-                        meta = node.get("metadata", {})
-                        score = node.get("score", 0)
-                        
-                        # Get fields from new schema
-                        doc_name = meta.get('doc_name', 'Văn bản pháp luật')
-                        short_name = meta.get('short_name', '')
-                        article_id = meta.get('article_id', '?')
-                        article_title = meta.get('article_title', '')
-                        chapter = meta.get('chapter', '')
-                        effective_date = meta.get('effective_date', '')
-                        
-                        # Short display name: "Đ.80 BLLĐ" hoặc "Đ.5 NĐ145"
-                        display_short = short_name if short_name else doc_name[:15]
-                        ref_name = f"Đ.{article_id} {display_short}"
-                        
-                        # Chỉ hiển thị nội dung gốc (đã có đầy đủ metadata)
-                        display_content = node.get('text', '')
-                        if effective_date:
-                            display_content += f"\n\n---\n*Hiệu lực: {effective_date}*"
-                        
-                        # Create Chainlit Text Element with SIDE display
-                        elements.append(
-                            cl.Text(
-                                name=ref_name,
-                                content=display_content,
-                                display="side"  # Click để mở side panel
-                            )
-                        )
-                        ref_names.append(ref_name)
+                    # Get fields from new schema
+                    doc_name = meta.get('doc_name', 'Văn bản pháp luật')
+                    short_name = meta.get('short_name', '')
+                    article_id = meta.get('article_id', '?')
+                    article_title = meta.get('article_title', '')
+                    chapter = meta.get('chapter', '')
+                    effective_date = meta.get('effective_date', '')
                     
-                    # Attach elements to message
-                    msg.elements = elements
+                    # Short display name: "Đ.80 BLLĐ" hoặc "Đ.5 NĐ145"
+                    display_short = short_name if short_name else doc_name[:15]
+                    ref_name = f"Đ.{article_id} {display_short}"
+                    
+                    # Chỉ hiển thị nội dung gốc (đã có đầy đủ metadata)
+                    display_content = node.get('text', '')
+                    if effective_date:
+                        display_content += f"\n\n---\n*Hiệu lực: {effective_date}*"
+                    
+                    # Create Chainlit Text Element with SIDE display
+                    elements.append(
+                        cl.Text(
+                            name=ref_name,
+                            content=display_content,
+                            display="side"  # Click để mở side panel
+                        )
+                    )
+                    ref_names.append(ref_name)
+                
+                # Attach elements to message
+                msg.elements = elements
+                
+                # Add footer with clickable references
+                if intent == "LAW":
+                    ref_links = " | ".join(ref_names)
+                    await msg.stream_token(f"\n\n---\n **Căn cứ pháp lý:** {ref_links}")
                     
-                    # Add footer with clickable references
-                    if intent == "LAW":
-                        ref_links = " | ".join(ref_names)
-                        await msg.stream_token(f"\n\n---\n **Căn cứ pháp lý:** {ref_links}")
-                        
-                    from datetime import datetime
-                    import os
-
-                    # LOG_PATH = "logs/chat_outputs.jsonl"
-                    # os.makedirs("logs", exist_ok=True)
-
-                    # record = {
-                    #     "question": message.content,
-                    #     "model": "LLM+RAG",  # hoặc LLM-base
-                    #     "answer": final_answer.strip(),
-                    #     "intent": intent,
-                    #     "retrieved_nodes": serialize_nodes(source_nodes),
-                    #     "timestamp": datetime.utcnow().isoformat()
-                    # }
-
-                    # with open(LOG_PATH, "a", encoding="utf-8") as f:
-                    #     f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                from datetime import datetime
+                import os
 
-                await msg.update()
+                # LOG_PATH = "logs/chat_outputs.jsonl"
+                # os.makedirs("logs", exist_ok=True)
+
+                # record = {
+                #     "question": message.content,
+                #     "model": "LLM+RAG",  # hoặc LLM-base
+                #     "answer": final_answer.strip(),
+                #     "intent": intent,
+                #     "retrieved_nodes": serialize_nodes(source_nodes),
+                #     "timestamp": datetime.utcnow().isoformat()
+                # }
+
+                # with open(LOG_PATH, "a", encoding="utf-8") as f:
+                #     f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-        except Exception as e:
-            msg.content = f"**Lỗi kết nối:** {str(e)}"
             await msg.update()
 
+    except Exception as e:
+        msg.content = f"**Lỗi kết nối:** {str(e)}"
+        await msg.update()
+
 
 # ============================================================================
 # ACTIONS & CALLBACKS
@@ -185,9 +221,8 @@ async def main(message: cl.Message):
 async def on_reset_memory(action: cl.Action):
     """Callback to reset conversation memory via UI button (if used)"""
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(f"{BACKEND_URL}/reset-memory")
-            data = resp.json()
+        resp = await http_client.post(f"{BACKEND_URL}/reset-memory", timeout=5.0)
+        data = resp.json()
             
         if data.get("success"):
             await cl.Message(content="**Đã xóa bộ nhớ hội thoại!**").send()
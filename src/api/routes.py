@@ -1,43 +1,80 @@
 """API Routes - Chat (SSE), Query, Health"""
-import json
 import logging
-from typing import List, Any
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from collections import OrderedDict
+from typing import List, Any, Dict
+from uuid import uuid4
+import orjson
+from fastapi import APIRouter, HTTPException, Depends, Response
+from pydantic import TypeAdapter
+from sse_starlette.sse import EventSourceResponse
 
 from src.api.schemas import (
     ChatRequest, QueryRequest, QueryResponse,
     ResetMemoryResponse, HealthResponse, SourceNode
 )
+from src.api.streaming import coalesce_tokens
 from src.engine.chat_engine import ChatEngineManager, get_chat_engine_manager
+from src.config import settings
 from src import __version__
 
 logger = logging.getLogger("uvicorn")
 router = APIRouter()
 
+# Serialize phía Rust (pydantic-core) 1 lần ra bytes; response_model chỉ còn dùng cho OpenAPI docs
+_NODES_ADAPTER = TypeAdapter(List[SourceNode])
 
-def _convert_source_nodes(source_nodes: List[Any]) -> List[SourceNode]:
-    """Convert LlamaIndex nodes to API schema with deduplication by article."""
+
+def _dedup_source_nodes(source_nodes: List[Any]) -> List[Any]:
+    """Giữ node điểm cao nhất cho mỗi điều luật, sắp xếp theo điểm giảm dần."""
     seen = {}
     for node in source_nodes:
         meta = node.node.metadata or {}
-        article_key = f"{meta.get('doc_number', '')}_{meta.get('article_id', '')}_{meta.get('chapter', '')}"
-        score = node.score or 0.0
-        
-        if article_key not in seen or score > (seen[article_key].score or 0.0):
+        # article_key có sẵn từ lúc ingest; node ingest trước đó thì ghép cùng định dạng
+        article_key = meta.get('article_key') or (
+            f"{meta.get('doc_number', '')}|{meta.get('article_id', '')}|{meta.get('chapter', '')}"
+        )
+        best = seen.get(article_key)
+        if best is None or (node.score or 0.0) > (best.score or 0.0):
             seen[article_key] = node
-    
-    result = [
+    return sorted(seen.values(), key=lambda n: n.score or 0.0, reverse=True)
+
+
+def _convert_source_nodes(source_nodes: List[Any]) -> List[SourceNode]:
+    """Convert LlamaIndex nodes to API schema with deduplication by article."""
+    return [
         SourceNode(
             text=node.node.get_content(),
             score=node.score,
             id=node.node.node_id,
             metadata=node.node.metadata or {}
         )
-        for node in seen.values()
+        for node in _dedup_source_nodes(source_nodes)
     ]
-    result.sort(key=lambda x: x.score or 0.0, reverse=True)
-    return result
+
+
+def _source_node_dicts(source_nodes: List[Any], preview_chars: int) -> List[Dict[str, Any]]:
+    """Dict cho SSE payload từ node đã dedup (bỏ qua validate + model_dump), text chỉ là preview."""
+    return [
+        {
+            "text": node.node.get_content()[:preview_chars],
+            "score": node.score,
+            "id": node.node.node_id,
+            "metadata": node.node.metadata or {},
+        }
+        for node in source_nodes
+    ]
+
+
+# nodes_id → source nodes đầy đủ của 1 lượt chat (SSE chỉ gửi preview), LRU theo NODE_STORE_SIZE
+_node_store: "OrderedDict[str, List[Any]]" = OrderedDict()
+
+
+def _store_source_nodes(source_nodes: List[Any]) -> str:
+    nodes_id = uuid4().hex
+    _node_store[nodes_id] = source_nodes
+    if len(_node_store) > settings.NODE_STORE_SIZE:
+        _node_store.popitem(last=False)
+    return nodes_id
 
 
 @router.post("/chat")
@@ -48,7 +85,7 @@ async def chat(
     """Streaming Chat Endpoint (SSE)."""
     async def event_generator():
         try:
-            async for text, intent, nodes in engine.astream_chat(request.content):
+            async for text, intent, nodes in coalesce_tokens(engine.astream_chat(request.content)):
                 payload = {}
                 
                 if text:
@@ -58,18 +95,21 @@ async def chat(
                     payload["intent"] = str(intent.value) if hasattr(intent, 'value') else str(intent)
                 
                 if nodes:
-                    converted_nodes = _convert_source_nodes(nodes)
-                    payload["nodes"] = [node.model_dump() for node in converted_nodes]
+                    nodes = _dedup_source_nodes(nodes)
+                    payload["nodes"] = _source_node_dicts(nodes, settings.SSE_NODE_PREVIEW_CHARS)
+                    payload["nodes_id"] = _store_source_nodes(nodes)
                 
                 if payload:
-                    json_data = json.dumps(payload, ensure_ascii=False)
-                    yield f"data: {json_data}\n\n"
+                    # orjson ghi UTF-8 trực tiếp (tiếng Việt không bị escape), metadata có thể có key không phải str
+                    yield {"data": orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()}
                     
         except Exception as e:
             logger.error(f"Chat Error: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+            yield {"data": orjson.dumps({'error': str(e)}).decode()}
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    # EventSourceResponse lo framing "data: ...", ping keep-alive (proxy không cắt stream dài)
+    # và header X-Accel-Buffering: no; sep="\n" giữ nguyên định dạng dòng mà client đang parse
+    return EventSourceResponse(event_generator(), ping=15, sep="\n")
 
 
 @router.post("/query", response_model=QueryResponse)
@@ -80,15 +120,25 @@ async def query(
     """Simple RAG Query (non-conversational)."""
     try:
         response = await engine.chat_engine.achat(request.question)
-        return QueryResponse(
+        result = QueryResponse(
             result=str(response),
             source_nodes=_convert_source_nodes(response.source_nodes)
         )
+        return Response(result.model_dump_json(), media_type="application/json")
     except Exception as e:
         logger.error(f"Query Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/nodes/{nodes_id}", response_model=List[SourceNode])
+async def get_nodes(nodes_id: str):
+    """Full source nodes of a streamed chat turn (the SSE payload only carries previews)."""
+    nodes = _node_store.get(nodes_id)
+    if nodes is None:
+        raise HTTPException(status_code=404, detail="Nodes not found or expired")
+    return Response(_NODES_ADAPTER.dump_json(_convert_source_nodes(nodes)), media_type="application/json")
+
+
 @router.post("/reset-memory", response_model=ResetMemoryResponse)
 async def reset_memory(engine: ChatEngineManager = Depends(get_chat_engine_manager)):
     """Reset conversation memory."""
@@ -0,0 +1,65 @@
+"""Gom token của LLM stream thành chunk cho SSE"""
+import asyncio
+from time import perf_counter
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from src.config import settings
+
+
+async def coalesce_tokens(stream: AsyncIterator[Tuple[str, Any, Any]]) -> AsyncIterator[Tuple[str, Any, Any]]:
+    """
+    Gom token liên tiếp thành 1 chunk trước khi thành 1 SSE frame.
+    Flush khi đủ batch_size token hoặc token đầu tiên trong buffer đã chờ quá SSE_BATCH_MAX_DELAY_MS
+    (kể cả khi LLM đang dừng giữa chừng, chưa có token mới);
+    batch_size tăng dần từ SSE_BATCH_MIN_SIZE → SSE_BATCH_SIZE (token đầu tiên vẫn ra ngay).
+    Item có intent/nodes đi qua nguyên vẹn, sau khi flush phần token còn lại.
+    """
+    max_delay = settings.SSE_BATCH_MAX_DELAY_MS / 1000
+    batch_size = float(settings.SSE_BATCH_MIN_SIZE)
+    buf: List[str] = []
+    deadline = 0.0
+    it = stream.__aiter__()
+    # __anext__ đang chạy trong task riêng để đua với hạn flush; không huỷ giữa chừng (sẽ làm hỏng generator)
+    pending: Optional[asyncio.Future] = None
+
+    try:
+        while True:
+            try:
+                if pending is None and not buf:
+                    # Buffer rỗng → không có hạn nào để canh, đợi thẳng trên task hiện tại (giữ context của request)
+                    text, intent, nodes = await it.__anext__()
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(it.__anext__())
+                    timeout = max(deadline - perf_counter(), 0.0) if buf else None
+                    done, _ = await asyncio.wait((pending,), timeout=timeout)
+                    if not done:
+                        yield "".join(buf), None, None
+                        buf.clear()
+                        batch_size = min(batch_size * settings.SSE_BATCH_SIZE_GROWTH_FACTOR, settings.SSE_BATCH_SIZE)
+                        continue
+                    next_item, pending = pending, None
+                    text, intent, nodes = next_item.result()
+            except StopAsyncIteration:
+                break
+
+            if text:
+                if not buf:
+                    deadline = perf_counter() + max_delay
+                buf.append(text)
+                if len(buf) >= batch_size or perf_counter() >= deadline:
+                    yield "".join(buf), None, None
+                    buf.clear()
+                    batch_size = min(batch_size * settings.SSE_BATCH_SIZE_GROWTH_FACTOR, settings.SSE_BATCH_SIZE)
+
+            if intent or nodes:
+                if buf:
+                    yield "".join(buf), None, None
+                    buf.clear()
+                yield "", intent, nodes
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+    if buf:
+        yield "".join(buf), None, None
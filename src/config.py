@@ -1,4 +1,4 @@
-from typing import Optional, Literal
+from typing import List, Optional, Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
 
@@ -29,22 +29,43 @@ class Settings(BaseSettings):
     EMBEDDING_MODEL: str = "AITeamVN/Vietnamese_Embedding"
     EMBEDDING_DIM: int = 1024
     EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_MAX_WORKERS: int = 2  # Thread encode cho các lời gọi async (tránh tranh GPU/CPU)
+    EMBED_CACHE_SIZE: int = 2048    # LRU embedding của query (0 = tắt)
      
     # ===== Reranker Settings =====
     RERANKER_MODEL: str = "BAAI/bge-reranker-v2-m3" #    "BAAI/bge-reranker-v2-m3" # thanhtantran/Vietnamese_Reranker
     RERANKER_TOP_N: int = 7        
+    RERANK_CACHE_SIZE: int = 10000  # LRU điểm cross-encoder theo (query, node_id) (0 = tắt)
     HUGGINGFACE_API_KEY: Optional[str] = None
+    MODEL_FP16: bool = True         # Embedding + reranker chạy FP16 khi có CUDA (CPU vẫn FP32)
     
     # ===== Qdrant Cloud Settings =====
     QDRANT_URL: str = "http://localhost:6333" 
     QDRANT_API_KEY: Optional[str] = None
     QDRANT_COLLECTION: str = "legal_decrees_LBV"
+    QDRANT_TIMEOUT: int = 10
+    QDRANT_PREFER_GRPC: bool = False    # gRPC (HTTP/2) cho search; cần mở cổng gRPC (Qdrant Cloud có sẵn)
+    QDRANT_GRPC_PORT: int = 6334
+    QDRANT_SCROLL_BATCH: int = 1024     # Số point mỗi lần scroll khi nạp node cho BM25 lúc khởi động
+    QDRANT_SCROLL_PARALLELISM: int = 4  # Số khoảng id scroll song song (1 = tuần tự)
     
     # ===== Retrieval Settings =====
     VECTOR_TOP_K: int = 15          
     BM25_TOP_K: int = 15
     HYBRID_TOP_K: int = 15          
     RRF_K: int = 30                 
+    BM25_DTYPE: Literal["float32", "float16"] = "float32"  # float16: ma trận điểm BM25 giảm ~25% bộ nhớ, top-k lệch nhẹ
+    BM25_BYPASS_LITERAL: bool = False   # Query mở đầu bằng "Điều/Khoản N" → chỉ dùng vector, bỏ BM25 + RRF
+    
+    # ===== Router Settings =====
+    ROUTER_CACHE_SIZE: int = 1024   # LRU kết quả phân loại intent (0 = tắt)
+    ROUTER_USE_KEYWORDS: bool = True    # Regex chào hỏi / thuật ngữ pháp lý, không cần embedding hay LLM
+    ROUTER_USE_EMBEDDING: bool = True   # Phân loại bằng cosine tới centroid LAW/CHAT trước khi gọi LLM
+    ROUTER_SIM_MARGIN: float = 0.05     # |score_law - score_chat| nhỏ hơn ngưỡng → hỏi LLM
+    
+    # ===== Persistent Cache =====
+    PERSIST_CACHES: bool = True         # Lưu cache embedding query + router xuống SQLite, nạp lại khi khởi động
+    CACHE_DIR: str = "~/.cache/rag"
     
     # ===== Memory Settings =====
     MEMORY_TOKEN_LIMIT: int = 12000 
@@ -57,9 +78,21 @@ class Settings(BaseSettings):
     PHOENIX_COLLECTOR_ENDPOINT: Optional[str] = None
     ENABLE_TRACING: bool = False
     
+    # ===== Streaming (SSE) Settings =====
+    # Gom token thành 1 frame: batch bắt đầu từ MIN, nhân GROWTH_FACTOR sau mỗi frame, tối đa SIZE
+    SSE_BATCH_MIN_SIZE: int = 1
+    SSE_BATCH_SIZE: int = 8
+    SSE_BATCH_SIZE_GROWTH_FACTOR: float = 2.0
+    SSE_BATCH_MAX_DELAY_MS: int = 40    # Token chờ quá lâu trong buffer → flush ngay
+    SSE_NODE_PREVIEW_CHARS: int = 300   # Text của source node trong SSE chỉ là preview, bản đầy đủ qua GET /nodes/{id}
+    NODE_STORE_SIZE: int = 256          # Số lượt chat gần nhất còn giữ source nodes đầy đủ
+    
     # ===== Server Settings =====
     API_HOST: str = "0.0.0.0"
     API_PORT: int = 8000
+    DEV_MODE: bool = False              # Auto-reload khi sửa code (chỉ dùng lúc phát triển)
+    API_WORKERS: int = 1                # Mỗi worker giữ model + chat memory + node store riêng → >1 chỉ khi đã sticky session
+    CORS_ORIGINS: str = "http://localhost:8501,http://127.0.0.1:8501"  # Danh sách origin, cách nhau bởi dấu phẩy
     
     # ===== Derived Properties =====
     @property
@@ -77,6 +110,10 @@ class Settings(BaseSettings):
         elif self.LLM_PROVIDER == "groq":
             return self.GROQ_API_KEY
         return self.OPENAI_API_KEY
+    
+    @property
+    def cors_origins(self) -> List[str]:
+        return [origin.strip() for origin in self.CORS_ORIGINS.split(",") if origin.strip()]
 
 
 @lru_cache()
@@ -1,16 +1,26 @@
+import json
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from typing import List, Optional, AsyncGenerator, Tuple
 from enum import Enum
 from dataclasses import dataclass
 
+import numpy as np
+
 from llama_index.core import VectorStoreIndex
 from llama_index.core.chat_engine import CondensePlusContextChatEngine
 from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core.schema import TextNode, NodeWithScore
+from llama_index.core.bridge.pydantic import PrivateAttr
 
 from src.config import settings
 from src.engine.components import get_llm, get_embed_model, get_reranker, get_vector_store
-from src.engine.retriever import HybridRetrieverFactory
+from src.engine.retriever import HybridRetrieverFactory, PrefetchRetriever
+from src.engine.persistent_cache import PersistentCache
 
 
 # =============================================================================
@@ -29,6 +39,59 @@ class RouterResult:
     reasoning: str
 
 
+# =============================================================================
+# ROUTER EXEMPLARS - câu mẫu để dựng centroid embedding cho từng intent
+# =============================================================================
+
+LAW_EXEMPLARS = [
+    "Nghỉ thai sản được bao lâu?",
+    "Trợ cấp thôi việc tính như thế nào?",
+    "BHXH là gì?",
+    "Công ty có được đơn phương chấm dứt hợp đồng lao động không?",
+    "Mức lương tối thiểu vùng 1 hiện nay là bao nhiêu?",
+    "Người lao động được nghỉ phép năm bao nhiêu ngày?",
+    "Làm thêm giờ được trả lương như thế nào?",
+    "Điều kiện hưởng trợ cấp thất nghiệp là gì?",
+    "Bị sa thải trái luật thì được bồi thường gì?",
+    "Tuổi nghỉ hưu của lao động nam là bao nhiêu?",
+    "Thời gian thử việc tối đa là bao lâu?",
+    "Mức đóng bảo hiểm y tế bắt buộc là bao nhiêu phần trăm?",
+    "Công ty sáp nhập thì người lao động có được trợ cấp mất việc làm không?",
+    "Lao động nữ mang thai có được làm việc nặng nhọc, độc hại không?",
+    "Hợp đồng lao động xác định thời hạn tối đa bao nhiêu năm?",
+]
+
+CHAT_EXEMPLARS = [
+    "Xin chào",
+    "Chào bạn",
+    "Bạn là ai?",
+    "Bạn có thể làm gì?",
+    "Cảm ơn bạn",
+    "Cảm ơn nhiều nhé",
+    "Tạm biệt",
+    "Hẹn gặp lại",
+    "Bạn khỏe không?",
+    "Bạn tên là gì?",
+    "Ok, tôi hiểu rồi",
+    "Hôm nay thời tiết thế nào?",
+]
+
+# Gate regex trước mọi bước khác: chỉ bắt các câu hiển nhiên, còn lại để embedding/LLM quyết định
+# LAW: có thuật ngữ pháp lý (kể cả khi mở đầu bằng lời chào, vd. "chào bạn, trợ cấp thôi việc tính sao?")
+LAW_KEYWORD_RE = re.compile(
+    r"\b(điều \d+|khoản \d+|bhxh|bhtn|bhyt|bảo hiểm|trợ cấp|thai sản|hợp đồng lao động|sa thải|"
+    r"nghỉ phép|nghỉ hưu|thử việc|làm thêm giờ|sáp nhập|tiền lương|lương tối thiểu|"
+    r"bộ luật|luật lao động|nghị định)\b",
+    re.IGNORECASE,
+)
+# CHAT: cả câu chỉ là lời chào/cảm ơn/hỏi về bot (không có nội dung khác phía sau)
+CHAT_RE = re.compile(
+    r"^\s*(xin chào|chào|hi|hello|cảm ơn|cám ơn|tạm biệt|bạn là ai|bạn làm được gì|bạn có thể làm gì)"
+    r"( bạn| nhé| nha| nhiều| ạ)*\s*[.!?]*\s*$",
+    re.IGNORECASE,
+)
+
+
 # =============================================================================
 # PROMPTS
 # =============================================================================
@@ -107,9 +170,119 @@ Trả lời:"""
 # SEMANTIC ROUTER - Phân loại intent LAW/CHAT
 # =============================================================================
 
+# 1 worker → kết quả router ghi xuống disk tuần tự, đúng thứ tự put (write-behind)
+_ROUTER_DISK_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="router-cache")
+
+
+def _normalized_centroid(embeddings: List[List[float]]) -> np.ndarray:
+    centroid = np.asarray(embeddings, dtype=np.float32).mean(axis=0)
+    return centroid / np.linalg.norm(centroid)
+
+
 class SemanticRouter:
-    def __init__(self, llm=None):
+    """
+    Phân loại LAW/CHAT:
+    0. Regex từ khoá cho các câu hiển nhiên (chào hỏi / thuật ngữ pháp lý)
+    1. LRU cache theo (query, lịch sử)
+    2. Cosine giữa embedding câu hỏi và centroid LAW/CHAT (vài ms, local)
+    3. Chỉ gọi LLM khi 2 score quá sát nhau (< ROUTER_SIM_MARGIN) hoặc không có embed model
+    """
+    def __init__(self, llm=None, embed_model=None, cache_size: Optional[int] = None):
         self.llm = llm or get_llm()
+        self.embed_model = embed_model
+        self._law_centroid: Optional[np.ndarray] = None
+        self._chat_centroid: Optional[np.ndarray] = None
+        if embed_model is not None and settings.ROUTER_USE_EMBEDDING:
+            self._law_centroid = _normalized_centroid(embed_model.get_text_embedding_batch(LAW_EXEMPLARS))
+            self._chat_centroid = _normalized_centroid(embed_model.get_text_embedding_batch(CHAT_EXEMPLARS))
+        # LRU (query chuẩn hoá, hash lịch sử) → RouterResult, bỏ qua LLM khi câu lặp lại ("xin chào", "cảm ơn")
+        self.cache_size = settings.ROUTER_CACHE_SIZE if cache_size is None else cache_size
+        self._cache: "OrderedDict[Tuple[str, bytes], RouterResult]" = OrderedDict()
+        self._cache_lock = threading.Lock()  # dùng chung cho route() sync và aroute()
+        self._disk_cache: Optional[PersistentCache] = None
+        if settings.PERSIST_CACHES and self.cache_size > 0:
+            self._attach_disk_cache()
+    
+    def _attach_disk_cache(self):
+        # Đổi prompt, câu mẫu hay model → kết quả cũ không còn đúng → version mới, file cache mới
+        version = (
+            ROUTER_PROMPT, LAW_EXEMPLARS, CHAT_EXEMPLARS, settings.llm_model,
+            settings.EMBEDDING_MODEL if self._law_centroid is not None else None,
+            settings.ROUTER_SIM_MARGIN,
+        )
+        self._disk_cache = PersistentCache("router", version=version)
+        rows = self._disk_cache.load(self.cache_size)
+        with self._cache_lock:
+            for raw_key, raw_value in rows:
+                # key = hash lịch sử (8 byte) + query chuẩn hoá
+                data = json.loads(raw_value)
+                self._cache[(raw_key[8:].decode("utf-8"), raw_key[:8])] = RouterResult(
+                    intent=IntentType(data["intent"]), confidence=data["confidence"], reasoning=data["reasoning"]
+                )
+        print(f"💾 Loaded {len(rows)} cached router results")
+    
+    @staticmethod
+    def _cache_key(query: str, chat_history: str) -> Tuple[str, bytes]:
+        return query.strip().lower(), blake2b(chat_history.encode("utf-8"), digest_size=8).digest()
+    
+    def _cache_get(self, key: Tuple[str, bytes]) -> Optional[RouterResult]:
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+            return result
+    
+    def _cache_put(self, key: Tuple[str, bytes], result: RouterResult):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if self._disk_cache is not None:
+            # Ghi SQLite (commit, chờ lock chung với cache embedding) trên thread riêng, không chặn event loop
+            _ROUTER_DISK_WRITER.submit(self._disk_put, key, result)
+    
+    def _disk_put(self, key: Tuple[str, bytes], result: RouterResult):
+        query_key, history_key = key
+        try:
+            self._disk_cache.put(
+                history_key + query_key.encode("utf-8"),
+                json.dumps({
+                    "intent": result.intent.value, "confidence": result.confidence, "reasoning": result.reasoning
+                }, ensure_ascii=False).encode("utf-8"),
+            )
+        except Exception as e:
+            print(f"⚠️ Could not persist router result: {e}")
+    
+    @staticmethod
+    def quick_route(query: str) -> Optional[RouterResult]:
+        """Phân loại bằng regex (µs), None nếu câu không hiển nhiên"""
+        if not settings.ROUTER_USE_KEYWORDS:
+            return None
+        if LAW_KEYWORD_RE.search(query):
+            return RouterResult(intent=IntentType.LAW, confidence=0.99, reasoning="keyword")
+        if CHAT_RE.match(query):
+            return RouterResult(intent=IntentType.CHAT, confidence=0.99, reasoning="keyword")
+        return None
+    
+    def _classify_embedding(self, embedding: List[float], chat_history: str) -> Optional[RouterResult]:
+        """RouterResult theo centroid gần nhất, None nếu không đủ chắc chắn"""
+        q = np.asarray(embedding, dtype=np.float32)
+        q /= np.linalg.norm(q)
+        score_law = float(q @ self._law_centroid)
+        score_chat = float(q @ self._chat_centroid)
+        if abs(score_law - score_chat) < settings.ROUTER_SIM_MARGIN:
+            return None
+        # Có lịch sử mà embedding ra CHAT → có thể là follow-up ngắn ("vậy còn 5 năm?"), để LLM xét cùng lịch sử
+        if score_chat > score_law and chat_history:
+            return None
+        return RouterResult(
+            intent=IntentType.LAW if score_law > score_chat else IntentType.CHAT,
+            confidence=max(score_law, score_chat),
+            reasoning=f"embedding (law={score_law:.3f}, chat={score_chat:.3f})"
+        )
     
     def _parse_response(self, response_text: str) -> RouterResult:
         try:
@@ -132,15 +305,105 @@ class SemanticRouter:
     
     def route(self, query: str, chat_history: str = "") -> RouterResult:
         """Sync routing"""
+        result = self.quick_route(query)
+        if result is not None:
+            return result
+        
+        key = self._cache_key(query, chat_history)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        
+        if self._law_centroid is not None:
+            result = self._classify_embedding(self.embed_model.get_query_embedding(query), chat_history)
+            if result is not None:
+                self._cache_put(key, result)
+                return result
+        
         prompt = ROUTER_PROMPT.format(query=query, chat_history=chat_history or "(Chưa có)")
         response = self.llm.complete(prompt)
-        return self._parse_response(str(response))
+        result = self._parse_response(str(response))
+        self._cache_put(key, result)
+        return result
     
     async def aroute(self, query: str, chat_history: str = "") -> RouterResult:
         """Async routing"""
+        result = self.quick_route(query)
+        if result is not None:
+            return result
+        
+        key = self._cache_key(query, chat_history)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        
+        if self._law_centroid is not None:
+            result = self._classify_embedding(await self.embed_model.aget_query_embedding(query), chat_history)
+            if result is not None:
+                self._cache_put(key, result)
+                return result
+        
         prompt = ROUTER_PROMPT.format(query=query, chat_history=chat_history or "(Chưa có)")
         response = await self.llm.acomplete(prompt)
-        return self._parse_response(str(response))
+        result = self._parse_response(str(response))
+        self._cache_put(key, result)
+        return result
+
+
+# =============================================================================
+# MEMORY - ChatMemoryBuffer + cửa sổ message gần nhất cho router/CHAT prompt
+# =============================================================================
+
+HISTORY_MAX_TURNS = 5
+
+
+class RecentChatMemoryBuffer(ChatMemoryBuffer):
+    """
+    ChatMemoryBuffer giữ thêm deque HISTORY_MAX_TURNS lượt gần nhất, cập nhật ở mọi put/set/reset
+    (kể cả khi chat engine tự ghi) → đọc lịch sử gần đây không phải duyệt cả hội thoại.
+    """
+    
+    _recent: deque = PrivateAttr(default_factory=lambda: deque(maxlen=HISTORY_MAX_TURNS * 2))
+    _version: int = PrivateAttr(default=0)  # tăng mỗi lần lịch sử đổi, dùng làm key cache
+    
+    @property
+    def version(self) -> int:
+        return self._version
+    
+    def recent_messages(self) -> List[ChatMessage]:
+        return list(self._recent)
+    
+    def put(self, message: ChatMessage) -> None:
+        super().put(message)
+        self._recent.append(message)
+        self._version += 1
+    
+    async def aput(self, message: ChatMessage) -> None:
+        await super().aput(message)
+        self._recent.append(message)
+        self._version += 1
+    
+    def set(self, messages: List[ChatMessage]) -> None:
+        super().set(messages)
+        self._recent.clear()
+        self._recent.extend(messages)
+        self._version += 1
+    
+    async def aset(self, messages: List[ChatMessage]) -> None:
+        await super().aset(messages)
+        self._recent.clear()
+        self._recent.extend(messages)
+        self._version += 1
+    
+    def reset(self) -> None:
+        super().reset()
+        self._recent.clear()
+        self._version += 1
+    
+    async def areset(self) -> None:
+        await super().areset()
+        self._recent.clear()
+        self._version += 1
 
 
 # =============================================================================
@@ -163,9 +426,12 @@ class ChatEngineManager:
         self.reranker = None
         self.router = None
         self.hybrid_retriever = None
+        self.prefetch_retriever = None
         self.chat_engine = None
         self.memory = None
         self.vector_store = None
+        # (version memory, max_turns) → lịch sử đã format; 1 lượt gọi _get_recent_history 2-3 lần
+        self._history_cache: Tuple[Optional[Tuple[int, int]], str] = (None, "")
         self._initialized = False
     
     def initialize(self, nodes: Optional[List[TextNode]] = None):
@@ -187,7 +453,7 @@ class ChatEngineManager:
         
         # Router để phân loại intent
         print("[4/6] Initializing semantic router...")
-        self.router = SemanticRouter(self.llm)
+        self.router = SemanticRouter(self.llm, self.embed_model)
         
         # Vector store + Hybrid retriever
         print("[5/6] Creating vector index and hybrid retriever...")
@@ -206,10 +472,12 @@ class ChatEngineManager:
         
         # Chat engine với memory
         print("[6/6] Creating chat engine with memory...")
-        self.memory = ChatMemoryBuffer.from_defaults(token_limit=self.memory_token_limit)
+        self.memory = RecentChatMemoryBuffer.from_defaults(token_limit=self.memory_token_limit)
         
+        # Chat engine retrieve qua PrefetchRetriever để dùng lại kết quả retrieve chạy song song với router
+        self.prefetch_retriever = PrefetchRetriever(self.hybrid_retriever)
         self.chat_engine = CondensePlusContextChatEngine.from_defaults(
-            retriever=self.hybrid_retriever,
+            retriever=self.prefetch_retriever,
             llm=self.llm,
             memory=self.memory,
             node_postprocessors=[self.reranker] if self.reranker else None,
@@ -230,19 +498,22 @@ class ChatEngineManager:
         self._ensure_initialized()
         self.memory.reset()
     
-    def _get_recent_history(self, max_turns: int = 5) -> str:
+    def _get_recent_history(self, max_turns: int = HISTORY_MAX_TURNS) -> str:
         """Lấy lịch sử gần đây để router có context"""
         try:
-            messages = self.memory.get_all()
-            if not messages:
-                return ""
+            signature = (self.memory.version, max_turns)
+            if self._history_cache[0] == signature:
+                return self._history_cache[1]
+            messages = self.memory.recent_messages()
             recent = messages[-(max_turns * 2):]
             lines = []
             for msg in recent:
                 role = "Người dùng" if msg.role == MessageRole.USER else "Trợ lý"
                 content = msg.content[:200] + "..." if len(msg.content) > 200 else msg.content
                 lines.append(f"{role}: {content}")
-            return "\n".join(lines)
+            history = "\n".join(lines)
+            self._history_cache = (signature, history)
+            return history
         except Exception:
             return ""
     
@@ -258,6 +529,30 @@ class ChatEngineManager:
         response = await self.llm.acomplete(prompt)
         return response.text if hasattr(response, 'text') else str(response)
     
+    async def _aroute_with_prefetch(self, query: str, chat_history: str) -> RouterResult:
+        """
+        Router + retrieve song song: chưa có lịch sử thì chat engine không condense,
+        câu hỏi retrieve chính là query → retrieve luôn trong lúc chờ router.
+        Kết quả bị bỏ nếu intent là CHAT.
+        """
+        if chat_history:
+            return await self.router.aroute(query, chat_history)
+        
+        # Câu hiển nhiên thì biết intent ngay, không retrieve thừa cho lời chào
+        router_result = self.router.quick_route(query)
+        if router_result is not None:
+            return router_result
+        
+        self.prefetch_retriever.prefetch(query)
+        try:
+            router_result = await self.router.aroute(query, chat_history)
+        except BaseException:
+            self.prefetch_retriever.discard()
+            raise
+        if router_result.intent == IntentType.CHAT:
+            self.prefetch_retriever.discard()
+        return router_result
+    
     # =========================================================================
     # MAIN CHAT METHODS
     # =========================================================================
@@ -299,7 +594,7 @@ class ChatEngineManager:
         if skip_routing:
             intent = IntentType.LAW
         else:
-            router_result = await self.router.aroute(query, self._get_recent_history())
+            router_result = await self._aroute_with_prefetch(query, self._get_recent_history())
             intent = router_result.intent
             print(f"🎯 Router: {intent.value} (confidence: {router_result.confidence:.2f})")
 
@@ -308,7 +603,11 @@ class ChatEngineManager:
             self.memory.put(ChatMessage(role=MessageRole.USER, content=query))
             self.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=response_text or ""))
         else:
-            response = await self.chat_engine.achat(query)
+            try:
+                response = await self.chat_engine.achat(query)
+            finally:
+                # Request bị huỷ/lỗi trước khi engine retrieve → không để task prefetch treo lại
+                self.prefetch_retriever.discard()
             response_text = str(response) if response else ""
             source_nodes = response.source_nodes if hasattr(response, 'source_nodes') else []
         
@@ -327,7 +626,7 @@ class ChatEngineManager:
         if skip_routing:
             intent = IntentType.LAW
         else:
-            router_result = await self.router.aroute(query, self._get_recent_history())
+            router_result = await self._aroute_with_prefetch(query, self._get_recent_history())
             intent = router_result.intent
             print(f"🎯 Router: {intent.value} (confidence: {router_result.confidence:.2f})")
         
@@ -347,7 +646,10 @@ class ChatEngineManager:
             yield "", intent, []
         else:
             # Stream từ RAG chat engine
-            streaming_response = await self.chat_engine.astream_chat(query)
+            try:
+                streaming_response = await self.chat_engine.astream_chat(query)
+            finally:
+                self.prefetch_retriever.discard()
             source_nodes = []
             
             async for chunk in streaming_response.async_response_gen():
@@ -1,27 +1,43 @@
 """Engine Components Factory - LLM, Embedding, Reranker, Qdrant"""
 import os
-from typing import Optional
+import asyncio
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Dict, List, Optional
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from llama_index.core.llms import LLM
 from llama_index.core.embeddings import BaseEmbedding
 from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
 from llama_index.postprocessor.sbert_rerank import SentenceTransformerRerank
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload, LlamaDebugHandler
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.events.rerank import ReRankEndEvent, ReRankStartEvent
 from llama_index.core import Settings
+from llama_index.core.bridge.pydantic import PrivateAttr
 from qdrant_client import QdrantClient, AsyncQdrantClient
+import numpy as np
 
 from src.config import settings
+from src.engine.persistent_cache import PersistentCache
+
+dispatcher = get_dispatcher(__name__)
 
 
 @lru_cache()
 def get_llm() -> LLM:
     """Get LLM instance based on configuration (Groq/Gemini/OpenAI)."""
-    debug_handler = LlamaDebugHandler(print_trace_on_end=True)
-    callback_manager = CallbackManager([debug_handler])
-    Settings.callback_manager = callback_manager
+    # Debug handler ghi lại mọi event LLM/retrieve → chỉ bật khi tracing, production dùng callback mặc định
+    callback_kwargs = {}
+    if settings.ENABLE_TRACING:
+        callback_manager = CallbackManager([LlamaDebugHandler(print_trace_on_end=False)])
+        Settings.callback_manager = callback_manager
+        callback_kwargs["callback_manager"] = callback_manager
     if settings.LLM_PROVIDER == "groq":
         from llama_index.llms.groq import Groq
         if not settings.GROQ_API_KEY:
@@ -33,7 +49,7 @@ def get_llm() -> LLM:
             temperature=settings.LLM_TEMPERATURE,
             max_tokens=settings.LLM_MAX_TOKENS,
             context_window=settings.LLM_CONTEXT_WINDOW,
-            callback_manager=callback_manager,
+            **callback_kwargs,
         )
     elif settings.LLM_PROVIDER == "gemini":
         from llama_index.llms.gemini import Gemini
@@ -62,6 +78,70 @@ def get_llm() -> LLM:
     return llm
 
 
+def _model_dtype_kwargs() -> dict:
+    """model_kwargs cho SentenceTransformer/CrossEncoder: FP16 khi chạy trên CUDA, CPU giữ FP32"""
+    if not settings.MODEL_FP16:
+        return {}
+    import torch
+    if not torch.cuda.is_available():
+        return {}
+    return {"torch_dtype": torch.float16}
+
+
+# Thread pool riêng, giới hạn số encode chạy đồng thời
+_EMBED_EXECUTOR = ThreadPoolExecutor(max_workers=settings.EMBEDDING_MAX_WORKERS, thread_name_prefix="embed")
+
+
+class ThreadedHuggingFaceEmbedding(HuggingFaceEmbedding):
+    """HuggingFaceEmbedding với bản async chạy encode trên thread pool, không chặn event loop.
+    
+    Embedding của query được giữ trong LRU (câu lặp lại: router + retrieve, follow-up, refresh),
+    có thể kèm PersistentCache để giữ LRU qua các lần restart.
+    """
+    
+    _query_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _query_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _disk_cache: Optional[PersistentCache] = PrivateAttr(default=None)
+    
+    def attach_disk_cache(self, disk_cache: PersistentCache):
+        """Nạp các embedding đã lưu vào LRU, từ đó mỗi embedding mới cũng được ghi xuống disk"""
+        rows = disk_cache.load(settings.EMBED_CACHE_SIZE)
+        with self._query_cache_lock:
+            for key, value in rows:
+                self._query_cache[key] = np.frombuffer(value, dtype=np.float32).tolist()
+        self._disk_cache = disk_cache
+        print(f"💾 Loaded {len(rows)} cached query embeddings")
+    
+    def _get_query_embedding(self, query: str) -> List[float]:
+        if settings.EMBED_CACHE_SIZE <= 0:
+            return super()._get_query_embedding(query)
+        
+        key = blake2b(query.encode("utf-8"), digest_size=16).digest()
+        with self._query_cache_lock:
+            embedding = self._query_cache.get(key)
+            if embedding is not None:
+                self._query_cache.move_to_end(key)
+                return embedding
+        
+        embedding = super()._get_query_embedding(query)
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            if len(self._query_cache) > settings.EMBED_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        if self._disk_cache is not None:
+            self._disk_cache.put(key, np.asarray(embedding, dtype=np.float32).tobytes())
+        return embedding
+    
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.get_running_loop().run_in_executor(_EMBED_EXECUTOR, self._get_query_embedding, query)
+    
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await asyncio.get_running_loop().run_in_executor(_EMBED_EXECUTOR, self._get_text_embedding, text)
+    
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(_EMBED_EXECUTOR, self._get_text_embeddings, texts)
+
+
 @lru_cache()
 def get_embed_model() -> BaseEmbedding:
     """Get Vietnamese embedding model (HuggingFace)."""
@@ -70,49 +150,161 @@ def get_embed_model() -> BaseEmbedding:
     cache_folder = os.path.expanduser("~/.cache/huggingface/hub")
     os.makedirs(cache_folder, exist_ok=True)
     
-    embed_model = HuggingFaceEmbedding(
+    embed_model = ThreadedHuggingFaceEmbedding(
         model_name=settings.EMBEDDING_MODEL,
         embed_batch_size=settings.EMBEDDING_BATCH_SIZE,
         trust_remote_code=True,
         cache_folder=cache_folder,
+        model_kwargs=_model_dtype_kwargs(),
     )
+    if settings.PERSIST_CACHES and settings.EMBED_CACHE_SIZE > 0:
+        embed_model.attach_disk_cache(PersistentCache("query_embed", version=settings.EMBEDDING_MODEL))
     print("✅ Embedding model loaded successfully")
     return embed_model
 
 
+# Metadata ghép vào input cross-encoder, cố định ở đây thay vì theo excluded_embed_metadata_keys của node:
+# node từ Qdrant (ingest bỏ hết metadata khỏi EMBED) và node BM25 dựng lại ở main.py có exclusion khác nhau
+RERANK_METADATA_KEYS = ("doc_type", "doc_name", "chapter", "article_title")
+
+
+def _rerank_text(node: BaseNode) -> str:
+    """Input cross-encoder giống nhau cho mọi đường retrieve: "key: value" từng dòng, dòng trống, rồi nội dung"""
+    content = node.get_content(metadata_mode=MetadataMode.NONE)
+    metadata = node.metadata
+    header = "\n".join(f"{key}: {metadata[key]}" for key in RERANK_METADATA_KEYS if metadata.get(key))
+    return f"{header}\n\n{content}" if header else content
+
+
+class CachedSentenceTransformerRerank(SentenceTransformerRerank):
+    """
+    SentenceTransformerRerank + LRU điểm theo (query, node_id): chỉ cross-encode các cặp chưa có điểm
+    (RERANK_CACHE_SIZE = 0 → không giữ điểm). Input cross-encoder dựng bằng _rerank_text.
+    """
+    
+    _score_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _score_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedSentenceTransformerRerank"
+    
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if not nodes:
+            return []
+        
+        # Giữ nguyên event của SentenceTransformerRerank → tracing (Phoenix) vẫn có span reranking
+        dispatcher.event(
+            ReRankStartEvent(query=query_bundle, nodes=nodes, top_n=self.top_n, model_name=self.model)
+        )
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.MODEL_NAME: self.model,
+                EventPayload.QUERY_STR: query_bundle.query_str,
+                EventPayload.TOP_K: self.top_n,
+            },
+        ) as event:
+            new_nodes = self._score_nodes(nodes, query_bundle.query_str)
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+        
+        dispatcher.event(ReRankEndEvent(nodes=new_nodes))
+        return new_nodes
+    
+    def _score_nodes(self, nodes: List[NodeWithScore], query_str: str) -> List[NodeWithScore]:
+        """Điểm cross-encoder lấy từ cache, chỉ predict các cặp chưa có"""
+        keys = [
+            blake2b(f"{query_str}\0{node.node.node_id}".encode("utf-8"), digest_size=16).digest()
+            for node in nodes
+        ]
+        
+        scores: Dict[bytes, float] = {}
+        with self._score_cache_lock:
+            for key in keys:
+                score = self._score_cache.get(key)
+                if score is not None:
+                    self._score_cache.move_to_end(key)
+                    scores[key] = score
+        
+        missing = [i for i, key in enumerate(keys) if key not in scores]
+        if missing:
+            predicted = self._model.predict([
+                (query_str, _rerank_text(nodes[i].node))
+                for i in missing
+            ])
+            for i, score in zip(missing, predicted):
+                scores[keys[i]] = float(score)
+            if settings.RERANK_CACHE_SIZE > 0:
+                with self._score_cache_lock:
+                    for i in missing:
+                        self._score_cache[keys[i]] = scores[keys[i]]
+                    while len(self._score_cache) > settings.RERANK_CACHE_SIZE:
+                        self._score_cache.popitem(last=False)
+        
+        for node, key in zip(nodes, keys):
+            if self.keep_retrieval_score:
+                node.node.metadata["retrieval_score"] = node.score
+            node.score = scores[key]
+        
+        return sorted(nodes, key=lambda x: x.score or 0.0, reverse=True)[:self.top_n]
+
+
 @lru_cache()
 def get_reranker(top_n: Optional[int] = None) -> BaseNodePostprocessor:
     """Get reranker model (SentenceTransformer)."""
     top_n = top_n or settings.RERANKER_TOP_N
     print(f"🎯 Loading reranker: {settings.RERANKER_MODEL}")
     
-    reranker = SentenceTransformerRerank(model=settings.RERANKER_MODEL, top_n=top_n)
+    reranker = CachedSentenceTransformerRerank(
+        model=settings.RERANKER_MODEL,
+        top_n=top_n,
+        cross_encoder_kwargs={"model_kwargs": _model_dtype_kwargs()},
+    )
     print("✅ Reranker loaded successfully")
     return reranker
 
 
+def _qdrant_client_kwargs() -> dict:
+    kwargs = {"url": settings.QDRANT_URL, "timeout": settings.QDRANT_TIMEOUT}
+    if settings.QDRANT_API_KEY:
+        kwargs["api_key"] = settings.QDRANT_API_KEY
+    if settings.QDRANT_PREFER_GRPC:
+        kwargs.update(prefer_grpc=True, grpc_port=settings.QDRANT_GRPC_PORT)
+    return kwargs
+
+
+@lru_cache()
 def get_qdrant_client() -> QdrantClient:
-    """Get Qdrant client (sync)."""
+    """Get Qdrant client (sync), shared so the connection pool is reused."""
     if settings.QDRANT_API_KEY:
         print(f"☁️  Connecting to Qdrant Cloud: {settings.QDRANT_URL}")
-        client = QdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
     else:
         print(f"🖥️  Connecting to local Qdrant: {settings.QDRANT_URL}")
-        client = QdrantClient(url=settings.QDRANT_URL)
+    client = QdrantClient(**_qdrant_client_kwargs())
     
     print("✅ Qdrant client connected")
     return client
 
 
+@lru_cache()
+def get_async_qdrant_client() -> AsyncQdrantClient:
+    """Get Qdrant client (async), shared so the connection pool is reused."""
+    return AsyncQdrantClient(**_qdrant_client_kwargs())
+
+
 def get_vector_store(client=None, collection_name: Optional[str] = None) -> QdrantVectorStore:
     """Get Qdrant vector store with both sync and async clients."""
     if client is None:
         client = get_qdrant_client()
     
-    if settings.QDRANT_API_KEY:
-        aclient = AsyncQdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
-    else:
-        aclient = AsyncQdrantClient(url=settings.QDRANT_URL)
+    aclient = get_async_qdrant_client()
 
     collection_name = collection_name or settings.QDRANT_COLLECTION
     
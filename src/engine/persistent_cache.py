@@ -0,0 +1,48 @@
+"""
+Persistent Cache - lớp SQLite phía sau các LRU in-memory (embedding query, router)
+Giữ cache qua các lần restart/redeploy: lúc khởi động nạp lại các key mới nhất vào LRU
+"""
+import os
+import sqlite3
+import threading
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any, List, Tuple
+
+from src.config import settings
+
+
+class PersistentCache:
+    """
+    Bảng key/value (BLOB) trong file <CACHE_DIR>/<namespace>_<version>.sqlite.
+    version = hash các yếu tố làm cache cũ mất giá trị (model, prompt, ...) → đổi là sang file mới.
+    """
+
+    def __init__(self, namespace: str, version: Any = None):
+        cache_dir = Path(os.path.expanduser(settings.CACHE_DIR))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        digest = blake2b(repr(version).encode("utf-8"), digest_size=6).hexdigest()
+        self.path = cache_dir / f"{namespace}_{digest}.sqlite"
+
+        # Ghi từ thread pool embedding lẫn event loop → 1 connection dùng chung, khoá bằng lock
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+        self._lock = threading.Lock()
+
+    def load(self, limit: int) -> List[Tuple[bytes, bytes]]:
+        """limit entry ghi gần nhất (cũ → mới, đúng thứ tự LRU), xoá phần còn lại khỏi disk"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM entries WHERE rowid NOT IN "
+                "(SELECT rowid FROM entries ORDER BY rowid DESC LIMIT ?)",
+                (limit,),
+            )
+            rows = self._conn.execute("SELECT key, value FROM entries ORDER BY rowid").fetchall()
+        return rows
+
+    def put(self, key: bytes, value: bytes):
+        # REPLACE cấp rowid mới → rowid tăng dần theo thời điểm ghi
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", (key, value))
@@ -1,24 +1,112 @@
 """
 Hybrid Retriever - Vector + BM25 with RRF Fusion
 """
-from typing import List
-from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import asyncio
+import heapq
+import shutil
+import tempfile
+import multiprocessing
+from collections import defaultdict
+from functools import partial
+from hashlib import blake2b
+from itertools import chain
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar
 
+import bm25s
+import numpy as np
 from llama_index.core.retrievers import BaseRetriever
-from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
 from llama_index.core import VectorStoreIndex
-from llama_index.retrievers.bm25 import BM25Retriever
 
 from src.config import settings
 
 
+# Giống mặc định của llama-index BM25Retriever → index/kết quả không đổi khi thay retriever
+BM25_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+# Corpus từ cỡ này trở lên mới tokenize song song nhiều process (process spawn phải import lại app, mất vài giây)
+BM25_PARALLEL_TOKENIZE_MIN = 50_000
+BM25_TOKENIZE_SHARD = 2048
+
+_tokenize_corpus = partial(
+    bm25s.tokenize, stopwords="en", stemmer=None, token_pattern=BM25_TOKEN_PATTERN, show_progress=False
+)
+
+
+class BM25sRetriever(BaseRetriever):
+    """
+    BM25 trên index bm25s (ma trận sparse, chấm điểm bằng NumPy), trả thẳng node gốc theo vị trí
+    thay vì dựng lại node từ corpus dict (json.loads _node_content) cho mỗi kết quả.
+    Tiếng Việt: không stemmer (Snowball tiếng Anh không áp dụng, chỉ tốn CPU).
+    """
+    
+    def __init__(self, nodes: List[TextNode], bm25: bm25s.BM25, top_k: int, **kwargs):
+        super().__init__(**kwargs)
+        self._nodes = nodes
+        self._bm25 = bm25
+        self.top_k = min(top_k, len(nodes))
+    
+    @staticmethod
+    def corpus_texts(nodes: List[TextNode]) -> List[str]:
+        """Text được index (giống text embed), dựng 1 lần rồi dùng chung cho hash cache lẫn tokenize"""
+        return [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    
+    @staticmethod
+    def build_index(texts: List[str]) -> bm25s.BM25:
+        workers = os.cpu_count() or 1
+        if len(texts) >= BM25_PARALLEL_TOKENIZE_MIN and workers > 1:
+            corpus_tokens = BM25sRetriever._tokenize_parallel(texts, workers)
+        else:
+            corpus_tokens = _tokenize_corpus(texts)
+        bm25 = bm25s.BM25(dtype=settings.BM25_DTYPE)
+        bm25.index(corpus_tokens, show_progress=False)
+        return bm25
+    
+    @staticmethod
+    def _tokenize_parallel(texts: List[str], workers: int) -> List[List[str]]:
+        """
+        Tokenize theo shard trên nhiều process, trả token dạng chuỗi (id vocab của từng shard không gộp được).
+        spawn thay vì fork: lúc khởi động các thread khác đang load model, fork giữa chừng dễ deadlock.
+        """
+        shards = [texts[i:i + BM25_TOKENIZE_SHARD] for i in range(0, len(texts), BM25_TOKENIZE_SHARD)]
+        tokenize_shard = partial(_tokenize_corpus, return_ids=False)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return [tokens for shard_tokens in pool.map(tokenize_shard, shards) for tokens in shard_tokens]
+    
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query_tokens = bm25s.tokenize(
+            query_bundle.query_str, stemmer=None, token_pattern=BM25_TOKEN_PATTERN, show_progress=False
+        )
+        indexes, scores = self._bm25.retrieve(query_tokens, k=self.top_k, show_progress=False)
+        return [
+            NodeWithScore(node=self._nodes[int(idx)], score=float(score))
+            for idx, score in zip(indexes[0], scores[0])
+        ]
+
+
+# Từ số ứng viên này trở lên mới fuse bằng NumPy (pool nhỏ thì overhead tạo array lớn hơn phần tiết kiệm)
+RRF_NUMPY_MIN_CANDIDATES = 256
+
+# Tra cứu nguyên văn ("Điều 12 ...", "khoản 3 ...") → nhánh vector là đủ khi bật BM25_BYPASS_LITERAL
+_LITERAL_RE = re.compile(r"^\s*(điều|article|khoản)\s+\d+", re.IGNORECASE)
+
+# Pool dùng chung cho nhánh vector/BM25 của _retrieve (sync), không tạo thread mới mỗi query
+_RETRIEVE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-retrieve")
+
+
 class HybridRetriever(BaseRetriever):
     """Hybrid Retriever combining Dense Vector Search and BM25 with RRF fusion."""
     
     def __init__(
         self,
         vector_retriever: BaseRetriever,
-        bm25_retriever: BM25Retriever,
+        bm25_retriever: BaseRetriever,
         top_k: int = 15,
         rrf_k: int = 30,
         **kwargs
@@ -29,47 +117,201 @@ class HybridRetriever(BaseRetriever):
         self.top_k = top_k
         self.rrf_k = rrf_k
     
+    @staticmethod
+    def _is_literal_query(query_str: str) -> bool:
+        return settings.BM25_BYPASS_LITERAL and _LITERAL_RE.match(query_str) is not None
+    
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            vector_future = executor.submit(self.vector_retriever.retrieve, query_bundle)
-            bm25_future = executor.submit(self.bm25_retriever.retrieve, query_bundle)
-            
-            vector_nodes = vector_future.result()
-            bm25_nodes = bm25_future.result()
+        if self._is_literal_query(query_bundle.query_str):
+            return self.vector_retriever.retrieve(query_bundle)[:self.top_k]
         
-        fused_nodes = self._rrf_fusion(vector_nodes, bm25_nodes)
-        return fused_nodes[:self.top_k]
-    
+        vector_future = _RETRIEVE_EXECUTOR.submit(self.vector_retriever.retrieve, query_bundle)
+        bm25_future = _RETRIEVE_EXECUTOR.submit(self.bm25_retriever.retrieve, query_bundle)
+        
+        vector_nodes = vector_future.result()
+        bm25_nodes = bm25_future.result()
+        
+        return self._rrf_fusion(vector_nodes, bm25_nodes)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._is_literal_query(query_bundle.query_str):
+            return (await self.vector_retriever.aretrieve(query_bundle))[:self.top_k]
+        
+        # Vector dùng AsyncQdrantClient, BM25 là CPU thuần → đẩy sang thread, 2 nhánh chạy song song
+        vector_nodes, bm25_nodes = await asyncio.gather(
+            self.vector_retriever.aretrieve(query_bundle),
+            asyncio.to_thread(self.bm25_retriever.retrieve, query_bundle),
+        )
+
+        return self._rrf_fusion(vector_nodes, bm25_nodes)
+
     def _rrf_fusion(
         self,
         vector_nodes: List[NodeWithScore],
         bm25_nodes: List[NodeWithScore]
     ) -> List[NodeWithScore]:
-        rrf_scores = {}
-        node_map = {}
+        """top_k node theo điểm RRF (heap top-k thay vì sort toàn bộ)"""
+        if len(vector_nodes) + len(bm25_nodes) >= RRF_NUMPY_MIN_CANDIDATES:
+            return self._rrf_fusion_numpy(vector_nodes, bm25_nodes)
         
-        for rank, node in enumerate(vector_nodes, 1):
-            node_id = node.node.node_id
-            rrf_scores[node_id] = rrf_scores.get(node_id, 0) + 1 / (self.rrf_k + rank)
-            node_map[node_id] = node
+        rrf_scores = defaultdict(float)
+        node_map = {}
+        # 1 / (k + rank) tính 1 lần cho mọi rank, dùng chung cho cả 2 danh sách
+        inv_ranks = [1.0 / (self.rrf_k + rank) for rank in range(1, max(len(vector_nodes), len(bm25_nodes)) + 1)]
         
-        for rank, node in enumerate(bm25_nodes, 1):
+        # Key thẳng bằng node_id (str): CPython cache hash trên object str, node BM25 là node gốc
+        # → chỉ id của ~top_k node vector mới (từ payload Qdrant) phải hash 1 lần mỗi query.
+        # Vector trước → node_map giữ bản của vector khi trùng id
+        for inv_rank, node in chain(zip(inv_ranks, vector_nodes), zip(inv_ranks, bm25_nodes)):
             node_id = node.node.node_id
-            rrf_scores[node_id] = rrf_scores.get(node_id, 0) + 1 / (self.rrf_k + rank)
-            if node_id not in node_map:
-                node_map[node_id] = node
-        
-        sorted_ids = sorted(rrf_scores.keys(), key=lambda x: rrf_scores[x], reverse=True)
+            rrf_scores[node_id] += inv_rank
+            node_map.setdefault(node_id, node)
         
         return [
-            NodeWithScore(node=node_map[node_id].node, score=rrf_scores[node_id])
-            for node_id in sorted_ids
+            NodeWithScore(node=node_map[node_id].node, score=score)
+            for node_id, score in heapq.nlargest(self.top_k, rrf_scores.items(), key=itemgetter(1))
         ]
+    
+    def _rrf_fusion_numpy(
+        self,
+        vector_nodes: List[NodeWithScore],
+        bm25_nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        """Như _rrf_fusion nhưng cộng điểm/chọn top-k bằng NumPy, cho pool ứng viên lớn"""
+        all_nodes = vector_nodes + bm25_nodes
+        ids = np.array([node.node.node_id for node in all_nodes])
+        ranks = np.concatenate([np.arange(1, len(vector_nodes) + 1), np.arange(1, len(bm25_nodes) + 1)])
+        
+        # first = vị trí xuất hiện đầu tiên → ưu tiên bản của vector, và giữ thứ tự khi bằng điểm như bản dict
+        _, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        scores = np.zeros(len(first))
+        np.add.at(scores, inverse, 1.0 / (self.rrf_k + ranks))
+        
+        k = min(self.top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((first[top], -scores[top]))]
+        return [NodeWithScore(node=all_nodes[first[i]].node, score=float(scores[i])) for i in top]
+
+
+class PrefetchRetriever(BaseRetriever):
+    """
+    Bọc retriever: dùng lại kết quả đã retrieve sẵn (speculative) nếu trùng query.
+    Task prefetch gắn với context của request (ContextVar) → 2 request cùng query không lấy nhầm/đè task của nhau.
+    """
+    
+    def __init__(self, retriever: BaseRetriever, **kwargs):
+        super().__init__(**kwargs)
+        self.retriever = retriever
+        self._prefetched: ContextVar[Optional[Tuple[str, asyncio.Task]]] = ContextVar(
+            "prefetched_retrieval", default=None
+        )
+    
+    def prefetch(self, query_str: str) -> asyncio.Task:
+        """Bắt đầu retrieve (async) trên event loop, chạy song song với việc khác (vd. router)"""
+        task = asyncio.create_task(self.retriever.aretrieve(query_str))
+        # Kết quả có thể bị bỏ (intent CHAT) → luôn lấy exception để không bị log "never retrieved"
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._prefetched.set((query_str, task))
+        return task
+    
+    def discard(self):
+        """Huỷ task prefetch của request hiện tại nếu chưa được dùng"""
+        prefetched = self._prefetched.get()
+        if prefetched is not None:
+            self._prefetched.set(None)
+            prefetched[1].cancel()
+    
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retriever.retrieve(query_bundle)
+    
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        prefetched = self._prefetched.get()
+        if prefetched is not None and prefetched[0] == query_bundle.query_str:
+            self._prefetched.set(None)
+            return await prefetched[1]
+        return await self.retriever.aretrieve(query_bundle)
+
+
+# hash nội dung node → index bm25s đã dựng
+_BM25_CACHE: Dict[str, bm25s.BM25] = {}
 
 
 class HybridRetrieverFactory:
     """Factory for creating HybridRetriever instances."""
     
+    @staticmethod
+    def _nodes_digest(nodes: List[TextNode], texts: List[str]) -> str:
+        digest = blake2b(digest_size=8)
+        # dtype là một phần của index đã lưu → đổi BM25_DTYPE thì dựng/cache index mới
+        digest.update(settings.BM25_DTYPE.encode("utf-8"))
+        for node, text in zip(nodes, texts):
+            digest.update(node.node_id.encode("utf-8"))
+            digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+    
+    @staticmethod
+    def create_bm25_retriever(nodes: List[TextNode], top_k: int) -> BM25sRetriever:
+        """
+        Index bm25s cache theo hash nội dung node: trong process (_BM25_CACHE) và trên disk ở CACHE_DIR
+        → tạo lại engine hay restart đều không phải tokenize lại corpus.
+        """
+        texts = BM25sRetriever.corpus_texts(nodes)
+        digest = HybridRetrieverFactory._nodes_digest(nodes, texts)
+        bm25 = _BM25_CACHE.get(digest)
+        if bm25 is None:
+            bm25 = _BM25_CACHE[digest] = HybridRetrieverFactory._load_or_build_bm25(texts, digest)
+        return BM25sRetriever(nodes, bm25, top_k)
+    
+    @staticmethod
+    def _load_or_build_bm25(texts: List[str], digest: str) -> bm25s.BM25:
+        if not settings.PERSIST_CACHES:
+            return BM25sRetriever.build_index(texts)
+        
+        path = Path(os.path.expanduser(settings.CACHE_DIR)) / f"bm25_{digest}"
+        if path.is_dir():
+            bm25 = HybridRetrieverFactory._load_bm25(path)
+            if bm25 is not None:
+                return bm25
+            shutil.rmtree(path, ignore_errors=True)
+        
+        bm25 = BM25sRetriever.build_index(texts)
+        try:
+            HybridRetrieverFactory._save_bm25(bm25, path)
+        except Exception as e:
+            print(f"⚠️ Could not save BM25 index to {path}: {e}")
+        return bm25
+    
+    @staticmethod
+    def _load_bm25(path: Path):
+        """Index đã lưu, None nếu hỏng/ghi dở → dựng lại"""
+        print(f"💾 Loading BM25 index from {path}")
+        try:
+            return bm25s.BM25.load(str(path))
+        except Exception as e:
+            print(f"⚠️ Ignoring BM25 index {path}: {e}")
+            return None
+    
+    @staticmethod
+    def _save_bm25(bm25: bm25s.BM25, path: Path):
+        # Thư mục tạm riêng mỗi process rồi rename → không load phải index ghi dở, các worker không đè nhau
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f"{path.name}.", suffix=".tmp", dir=path.parent)
+        try:
+            bm25.save(tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Worker khác đã ghi xong trước (rename thư mục không đè được thư mục đã có) → giữ bản đó
+                if not path.is_dir():
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    
+    @staticmethod
+    def invalidate_bm25_cache():
+        """Bỏ các BM25 index đã dựng trong process (vd. sau khi ingest lại rồi nạp node mới)"""
+        _BM25_CACHE.clear()
+    
     @staticmethod
     def create_from_index(
         index: VectorStoreIndex,
@@ -85,7 +327,7 @@ class HybridRetrieverFactory:
         rrf_k = rrf_k or settings.RRF_K
         
         vector_retriever = index.as_retriever(similarity_top_k=vector_top_k)
-        bm25_retriever = BM25Retriever.from_defaults(nodes=nodes, similarity_top_k=bm25_top_k)
+        bm25_retriever = HybridRetrieverFactory.create_bm25_retriever(nodes, bm25_top_k)
         
         return HybridRetriever(
             vector_retriever=vector_retriever,
@@ -1,15 +1,21 @@
 """FastAPI Main Application - Vietnam Labor Law RAG v3"""
 import os
 import sys
-import json
+import asyncio
+import uuid
+import pickle
+import tempfile
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, Optional
 
+import orjson
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from qdrant_client import QdrantClient
-from llama_index.core.schema import TextNode
+from fastapi.responses import ORJSONResponse
+from llama_index.core.schema import NodeWithScore, TextNode
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -18,6 +24,7 @@ from src import __version__
 from src.config import settings
 from src.api.routes import router
 from src.engine.chat_engine import ChatEngineManager, set_chat_engine_manager
+from src.engine.components import get_llm, get_embed_model, get_reranker, get_qdrant_client
 
 
 def setup_phoenix_tracing():
@@ -48,74 +55,159 @@ def setup_phoenix_tracing():
         print(f"⚠️ Phoenix tracing setup failed: {e}")
 
 
+# Metadata giữ lại cho node BM25: key → giá trị mặc định khi payload thiếu
+NODE_METADATA_DEFAULTS = {
+    'doc_type': '',
+    'doc_number': '',
+    'doc_name': '',
+    'short_name': '',
+    'chapter': '',
+    'article_id': '',
+    'article_title': '',
+    'effective_date': '',
+    'status': '',
+    'references': '[]',
+    'article_key': '',
+}
+NODE_EXCLUDED_METADATA_KEYS = ['article_key']
+# Giá trị lặp lại ở mọi node cùng văn bản/chương → intern để các node dùng chung 1 object str
+NODE_SHARED_METADATA_KEYS = ('doc_type', 'doc_number', 'doc_name', 'short_name', 'chapter', 'effective_date', 'status')
+
+
+def _point_id_order(point_id) -> tuple:
+    """Thứ tự id của Qdrant: id số đứng trước UUID, UUID so theo giá trị 128-bit"""
+    if isinstance(point_id, int):
+        return (0, point_id)
+    return (1, uuid.UUID(str(point_id)).int)
+
+
+def _scroll_id_range(client, start: Optional[str], end: Optional[str]) -> list:
+    """Scroll các point có id trong [start, end) (None = không giới hạn)"""
+    end_order = _point_id_order(end) if end is not None else None
+    points = []
+    offset = start
+    
+    while True:
+        batch_points, offset = client.scroll(
+            collection_name=settings.QDRANT_COLLECTION,
+            limit=settings.QDRANT_SCROLL_BATCH,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False
+        )
+        if end_order is not None:
+            batch_points = [p for p in batch_points if _point_id_order(p.id) < end_order]
+            if offset is not None and _point_id_order(offset) >= end_order:
+                offset = None
+        points.extend(batch_points)
+        if offset is None:
+            return points
+
+
+def _node_cache_path() -> Path:
+    # Đổi Qdrant/collection hay cách dựng metadata → file cache khác
+    key = f"{settings.QDRANT_URL}|{settings.QDRANT_COLLECTION}|{NODE_METADATA_DEFAULTS}|{NODE_EXCLUDED_METADATA_KEYS}"
+    digest = blake2b(key.encode("utf-8"), digest_size=6).hexdigest()
+    return Path(os.path.expanduser(settings.CACHE_DIR)) / f"nodes_{settings.QDRANT_COLLECTION}_{digest}.pkl"
+
+
+def _load_node_cache(path: Path, point_count: int) -> Optional[List[TextNode]]:
+    """Node đã dựng ở lần chạy trước, None nếu chưa có/hỏng/số point trong collection đã đổi"""
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Ignoring node cache {path}: {e}")
+        return None
+    if data.get("count") != point_count:
+        return None
+    return data["nodes"]
+
+
+def _save_node_cache(path: Path, point_count: int, nodes: List[TextNode]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # File tạm riêng mỗi process → các worker khởi động cùng lúc không ghi đè lên nhau
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"count": point_count, "nodes": nodes}, f, protocol=5)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
 def load_nodes_from_qdrant() -> List[TextNode]:
     """Load all nodes from Qdrant for BM25 index."""
     print("📚 Loading nodes from Qdrant for BM25 index...")
     
     try:
-        if settings.QDRANT_API_KEY:
-            client = QdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
-        else:
-            client = QdrantClient(url=settings.QDRANT_URL)
+        client = get_qdrant_client()
         
         collections = [c.name for c in client.get_collections().collections]
         if settings.QDRANT_COLLECTION not in collections:
             print(f"⚠️ Collection '{settings.QDRANT_COLLECTION}' not found")
             return []
         
-        points = []
-        offset = None
+        point_count = client.count(collection_name=settings.QDRANT_COLLECTION, exact=True).count
+        cache_path = _node_cache_path()
+        if settings.PERSIST_CACHES:
+            nodes = _load_node_cache(cache_path, point_count)
+            if nodes is not None:
+                print(f"💾 Loaded {len(nodes)} TextNodes from {cache_path}")
+                return nodes
         
-        while True:
-            result = client.scroll(
-                collection_name=settings.QDRANT_COLLECTION,
-                limit=100,
-                offset=offset,
-                with_payload=True,
-                with_vectors=False
+        # Point id là UUID4 (phân bố đều) → chia không gian id thành các khoảng, scroll song song
+        n_parts = max(1, settings.QDRANT_SCROLL_PARALLELISM)
+        bounds = [None] + [str(uuid.UUID(int=i * (2 ** 128 // n_parts))) for i in range(1, n_parts)] + [None]
+        with ThreadPoolExecutor(max_workers=n_parts) as executor:
+            parts = executor.map(
+                lambda i: _scroll_id_range(client, bounds[i], bounds[i + 1]), range(n_parts)
             )
-            batch_points, offset = result
-            points.extend(batch_points)
-            if offset is None:
-                break
+            points = [point for part in parts for point in part]
         
         print(f"📄 Loaded {len(points)} points from Qdrant")
         
         nodes = []
+        _TextNode = TextNode
+        _intern = sys.intern
+        metadata_defaults = NODE_METADATA_DEFAULTS.items()
         for i, point in enumerate(points):
             payload = point.payload or {}
             text = payload.get('text') or payload.get('_node_content') or ""
             
+            # _node_content là node đã serialize (key đầu là "id_", không phải "text") → chỉ lọc theo '{'
             if isinstance(text, str) and text.startswith('{'):
                 try:
-                    content_data = json.loads(text)
-                    text = content_data.get('text', text)
-                except:
+                    text = orjson.loads(text).get('text', text)
+                except orjson.JSONDecodeError:
                     pass
             
             if not text:
                 continue
             
-            metadata = {
-                'doc_type': payload.get('doc_type', ''),
-                'doc_number': payload.get('doc_number', ''),
-                'doc_name': payload.get('doc_name', ''),
-                'short_name': payload.get('short_name', ''),
-                'chapter': payload.get('chapter', ''),
-                'article_id': payload.get('article_id', ''),
-                'article_title': payload.get('article_title', ''),
-                'effective_date': payload.get('effective_date', ''),
-                'status': payload.get('status', ''),
-                'references': payload.get('references', '[]'),
-            }
+            metadata = {key: payload.get(key, default) for key, default in metadata_defaults}
+            for key in NODE_SHARED_METADATA_KEYS:
+                value = metadata[key]
+                if type(value) is str:
+                    metadata[key] = _intern(value)
             
-            nodes.append(TextNode(
+            nodes.append(_TextNode(
                 text=text,
                 metadata=metadata,
+                excluded_embed_metadata_keys=NODE_EXCLUDED_METADATA_KEYS,
+                excluded_llm_metadata_keys=NODE_EXCLUDED_METADATA_KEYS,
                 id_=str(point.id) if point.id else f"node_{i}"
             ))
         
         print(f"✅ Created {len(nodes)} TextNodes for BM25")
+        if settings.PERSIST_CACHES:
+            try:
+                _save_node_cache(cache_path, point_count, nodes)
+            except Exception as e:
+                print(f"⚠️ Could not save node cache to {cache_path}: {e}")
         return nodes
         
     except Exception as e:
@@ -123,6 +215,15 @@ def load_nodes_from_qdrant() -> List[TextNode]:
         return []
 
 
+def warmup_reranker():
+    """Load reranker + 1 lượt forward giả để request đầu không chịu chi phí khởi tạo kernel"""
+    reranker = get_reranker()
+    reranker.postprocess_nodes(
+        [NodeWithScore(node=TextNode(text="Người lao động được nghỉ phép năm 12 ngày."), score=0.0)],
+        query_str="warmup",
+    )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """FastAPI lifespan handler."""
@@ -132,9 +233,16 @@ async def lifespan(app: FastAPI):
     print("=" * 60)
     
     print("\n📦 Starting up...")
-    setup_phoenix_tracing()
     
-    nodes = load_nodes_from_qdrant()
+    # Đọc node từ Qdrant, load model và init tracing (OTEL SDK + instrumentor) song song
+    # (các getter đều lru_cache → initialize() dùng lại; tracing xong trước khi tạo engine)
+    nodes, *_ = await asyncio.gather(
+        asyncio.to_thread(load_nodes_from_qdrant),
+        asyncio.to_thread(setup_phoenix_tracing),
+        asyncio.to_thread(get_llm),
+        asyncio.to_thread(get_embed_model),
+        asyncio.to_thread(warmup_reranker),
+    )
     
     print("\n🔧 Initializing Chat Engine...")
     engine = ChatEngineManager(nodes=nodes)
@@ -164,13 +272,14 @@ app = FastAPI(
     """,
     version=__version__,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc",
 )
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=settings.cors_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -195,6 +304,7 @@ if __name__ == "__main__":
         "src.main:app",
         host=settings.API_HOST,
         port=settings.API_PORT,
-        reload=True,
+        reload=settings.DEV_MODE,
+        workers=settings.API_WORKERS,
         log_level="info"
     )
@@ -0,0 +1,52 @@
+"""coalesce_tokens: gom token cho SSE, flush theo hạn thời gian kể cả khi stream đang dừng"""
+import asyncio
+from time import perf_counter
+
+from src.api.streaming import coalesce_tokens
+from src.config import settings
+
+
+async def _fake_stream(items):
+    """items: (delay_giây, (text, intent, nodes)) — chờ delay rồi mới ra item"""
+    for delay, item in items:
+        await asyncio.sleep(delay)
+        yield item
+
+
+async def _collect(stream):
+    """[(thời điểm nhận, item)] tính từ lúc bắt đầu đọc"""
+    start = perf_counter()
+    return [(perf_counter() - start, item) async for item in coalesce_tokens(stream)]
+
+
+def test_flushes_buffered_tokens_while_stream_is_paused(monkeypatch):
+    monkeypatch.setattr(settings, "SSE_BATCH_MIN_SIZE", 8)
+    monkeypatch.setattr(settings, "SSE_BATCH_SIZE", 8)
+    monkeypatch.setattr(settings, "SSE_BATCH_MAX_DELAY_MS", 50)
+
+    pause = 0.5
+    items = [
+        (0.0, ("Xin", None, None)),
+        (0.0, (" chào", None, None)),
+        (pause, (" bạn", None, None)),  # LLM dừng lâu hơn nhiều so với max delay
+        (0.0, ("", "law", ["node"])),
+    ]
+    received = asyncio.run(_collect(_fake_stream(items)))
+
+    first_at, first = received[0]
+    assert first == ("Xin chào", None, None)
+    # Phải flush theo timer (~50ms), không đợi token kế tiếp (sau 500ms)
+    assert first_at < pause / 2
+    assert [item for _, item in received[1:]] == [(" bạn", None, None), ("", "law", ["node"])]
+
+
+def test_batches_fast_tokens_and_keeps_order(monkeypatch):
+    monkeypatch.setattr(settings, "SSE_BATCH_MIN_SIZE", 2)
+    monkeypatch.setattr(settings, "SSE_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "SSE_BATCH_MAX_DELAY_MS", 1000)
+
+    items = [(0.0, (token, None, None)) for token in ["a", "b", "c", "d", "e"]]
+    items.append((0.0, ("", "chat", [])))
+    received = [item for _, item in asyncio.run(_collect(_fake_stream(items)))]
+
+    assert received == [("ab", None, None), ("cd", None, None), ("e", None, None), ("", "chat", [])]